@@ -0,0 +1,143 @@
+import asyncio
+import logging
+import math
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class _SubstoreState:
+    def __init__(self, limit):
+        self.limit = float(limit)
+        self.in_flight = 0
+        self.baseline_latency = None
+        self.last_backoff = 0.0
+
+
+class _SubstoreSlot:
+    """Async context manager handing out one concurrency slot for a substore."""
+
+    def __init__(self, controller, substore_id):
+        self._controller = controller
+        self._substore_id = substore_id
+
+    async def __aenter__(self):
+        await self._controller.acquire(self._substore_id)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._controller.release(self._substore_id)
+        return False
+
+
+class AdaptiveConcurrencyController:
+    """AIMD controller for product API concurrency and request rate.
+
+    Each substore has its own concurrency limit. A 2xx response whose latency
+    stays within `latency_tolerance` of the best latency seen for that
+    substore grows its limit by 1/limit (about +1 per round trip) and the
+    shared rate limiter's rate by `rate_step`. A 406, 429, 5xx or network
+    error multiplies both by `backoff_factor`, at most once per
+    `backoff_cooldown` seconds per substore. Total in-flight requests across
+    all substores never exceed `global_limit`.
+    """
+
+    def __init__(
+        self,
+        rate_limiter,
+        initial_limit=1,
+        min_limit=1,
+        max_limit=8,
+        global_limit=16,
+        min_rate=1.0,
+        max_rate=20.0,
+        rate_step=0.5,
+        backoff_factor=0.5,
+        latency_tolerance=1.0,
+        backoff_cooldown=1.0,
+        enabled=True,
+    ):
+        self.rate_limiter = rate_limiter
+        self.initial_limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.global_limit = global_limit
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.rate_step = rate_step
+        self.backoff_factor = backoff_factor
+        self.latency_tolerance = latency_tolerance
+        self.backoff_cooldown = backoff_cooldown
+        self.enabled = enabled
+        self._states = {}  # substore_id -> _SubstoreState
+        self._in_flight = 0
+        self._condition = None
+
+    def _state(self, substore_id):
+        state = self._states.get(substore_id)
+        if state is None:
+            state = self._states[substore_id] = _SubstoreState(self.initial_limit)
+        return state
+
+    def limiter(self, substore_id):
+        """Return a semaphore-like slot provider for one substore."""
+        return _SubstoreSlot(self, substore_id)
+
+    async def acquire(self, substore_id):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        state = self._state(substore_id)
+        async with self._condition:
+            await self._condition.wait_for(
+                lambda: state.in_flight < math.floor(state.limit)
+                and self._in_flight < self.global_limit
+            )
+            state.in_flight += 1
+            self._in_flight += 1
+
+    async def release(self, substore_id):
+        state = self._state(substore_id)
+        async with self._condition:
+            state.in_flight -= 1
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    async def record(self, substore_id, status, latency):
+        """Feed one response outcome (status None for network errors)."""
+        if not self.enabled:
+            return
+        state = self._state(substore_id)
+        if status is not None and 200 <= status < 300:
+            if state.baseline_latency is None or latency < state.baseline_latency:
+                state.baseline_latency = latency
+            if latency <= state.baseline_latency * (1 + self.latency_tolerance):
+                previous_slots = math.floor(state.limit)
+                state.limit = min(self.max_limit, state.limit + 1 / state.limit)
+                self.rate_limiter.set_rate(
+                    min(self.max_rate, self.rate_limiter.rate + self.rate_step)
+                )
+                if math.floor(state.limit) > previous_slots and self._condition:
+                    async with self._condition:
+                        self._condition.notify_all()
+        elif status is None or status in (406, 429) or status >= 500:
+            now = time.monotonic()
+            if now - state.last_backoff < self.backoff_cooldown:
+                return
+            state.last_backoff = now
+            state.limit = max(self.min_limit, state.limit * self.backoff_factor)
+            self.rate_limiter.set_rate(
+                max(self.min_rate, self.rate_limiter.rate * self.backoff_factor)
+            )
+            logger.warning(
+                f"[ADAPTIVE] Backing off substore {substore_id} after status {status}: "
+                f"limit={state.limit:.2f}, rate={self.rate_limiter.rate:.2f}/s"
+            )
+
+    def stats(self):
+        return {
+            "rate": round(self.rate_limiter.rate, 2),
+            "limits": {
+                substore_id: round(state.limit, 2)
+                for substore_id, state in self._states.items()
+            },
+        }
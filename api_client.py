@@ -5,6 +5,7 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
 import requests
 import aiohttp
+import cloudscraper
 import time
 import random
 import hashlib
@@ -19,43 +20,77 @@ from config import (
     SETTINGS_URL,
     INFO_URL,
     API_URL,
-    PRODUCT_API_DELAY_RANGE,
-    GLOBAL_PRODUCT_API_RPS,
+    PRODUCT_API_BATCH_PAGE_SIZE,
+    API_RATE_LIMITS,
+    SEMAPHORE_LIMIT,
+    ADAPTIVE_CONCURRENCY_ENABLED,
+    ADAPTIVE_MIN_CONCURRENCY,
+    ADAPTIVE_MAX_CONCURRENCY,
+    ADAPTIVE_GLOBAL_CONCURRENCY,
+    ADAPTIVE_MIN_RPS,
+    ADAPTIVE_MAX_RPS,
+    ADAPTIVE_BACKOFF_FACTOR,
 )
+from adaptive_concurrency import AdaptiveConcurrencyController
+from http_client import create_isolated_session
+from response_cache import product_response_cache
+from rate_limiter import TokenBucketRateLimiter
 from utils import setup_logging
 
 logger = setup_logging()
 
 
-# --- Global Rate Limiter ---
-class AsyncRateLimiter:
-    def __init__(self, rate_per_sec):
-        self._interval = 1.0 / rate_per_sec
-        self._lock = None
-        self._last = 0.0
-
-    async def wait(self):
-        import asyncio
-
-        if self._lock is None:
-            self._lock = asyncio.Lock()
-        async with self._lock:
-            now = time.monotonic()
-            wait_time = max(0, self._last + self._interval - now)
-            if wait_time > 0:
-                logger.info(
-                    f"[RATE LIMIT] Waiting {wait_time:.2f}s to respect global rate limit"
-                )
-                await asyncio.sleep(wait_time)
-            self._last = time.monotonic()
+# --- Rate Limiters (one token bucket per endpoint) ---
+rate_limiters = {
+    endpoint: TokenBucketRateLimiter(rate, burst, name=endpoint)
+    for endpoint, (rate, burst) in API_RATE_LIMITS.items()
+}
+product_api_rate_limiter = rate_limiters["products"]
+product_api_controller = AdaptiveConcurrencyController(
+    product_api_rate_limiter,
+    initial_limit=SEMAPHORE_LIMIT,
+    min_limit=ADAPTIVE_MIN_CONCURRENCY,
+    max_limit=ADAPTIVE_MAX_CONCURRENCY,
+    global_limit=ADAPTIVE_GLOBAL_CONCURRENCY,
+    min_rate=ADAPTIVE_MIN_RPS,
+    max_rate=ADAPTIVE_MAX_RPS,
+    backoff_factor=ADAPTIVE_BACKOFF_FACTOR,
+    enabled=ADAPTIVE_CONCURRENCY_ENABLED,
+)
 
 
-product_api_rate_limiter = AsyncRateLimiter(GLOBAL_PRODUCT_API_RPS)
+def log_rate_limiter_stats():
+    for limiter in rate_limiters.values():
+        logger.info(f"[RATE LIMIT] Stats: {limiter.stats()}")
+    if product_api_controller.enabled:
+        logger.info(f"[ADAPTIVE] Final state: {product_api_controller.stats()}")
 
 
-def get_tid_and_substore(session, pincode):
-    logger.info(f"[SESSION] Creating session and substore for pincode: {pincode}")
-    headers = {
+class CloudflareChallengeError(Exception):
+    """Raised when the async bootstrap hits a Cloudflare challenge page."""
+
+
+class PincodeNotServiceableError(Exception):
+    """Raised when the pincode lookup returns no substore for a pincode."""
+
+
+class PincodeLookupError(Exception):
+    """Raised when the site rejects a pincode with a client error.
+
+    Only pincode-specific 4xx responses (not 429) raise this. Challenges,
+    rate limits, timeouts and server errors keep their own exceptions.
+    """
+
+
+def _check_pincode_status(pincode, status):
+    if 400 <= status < 500 and status != 429:
+        raise PincodeLookupError(
+            f"Pincode lookup returned {status} for pincode {pincode}"
+        )
+
+
+def _bootstrap_headers():
+    return {
         "user-agent": API_HEADERS["user-agent"],
         "accept": "application/json, text/plain, */*",
         "referer": BASE_URL + "/en/browse/protein",
@@ -74,35 +109,24 @@ def get_tid_and_substore(session, pincode):
         "priority": "u=1, i",
         "if-modified-since": "Tue, 01 Jul 2025 16:30:10 GMT",
     }
-    browse_url = f"{BASE_URL}/en/browse/protein"
-    logger.info(f"[SESSION] Visiting browse URL: {browse_url}")
-    browse_resp = session.get(browse_url, headers=headers, timeout=10)
-    logger.info(f"[SESSION] /en/browse/protein status: {browse_resp.status_code}")
-    # logger.info(f"[SESSION] /en/browse/protein response (first 300 chars): {browse_resp.text[:300]}")
-    pincode_params = {
+
+
+def _pincode_params(pincode):
+    return {
         "limit": 50,
         "filters[0][field]": "pincode",
         "filters[0][value]": str(pincode),
         "filters[0][operator]": "regex",
         "cf_cache": "1h",
     }
-    dummy_tid = "dummy"
-    tid_header = calculate_tid_header(dummy_tid)
-    pincode_headers = headers.copy()
-    pincode_headers["referer"] = BASE_URL + "/"
-    pincode_headers["tid"] = tid_header
-    pincode_url = PINCODE_URL + "?" + urlencode(pincode_params)
-    logger.info(f"[SESSION] Looking up substore for pincode: {pincode_url}")
-    pincode_resp = session.get(
-        PINCODE_URL, headers=pincode_headers, params=pincode_params, timeout=10
-    )
-    logger.info(f"[SESSION] /entity/pincode status: {pincode_resp.status_code}")
-    # logger.info(f"[SESSION] /entity/pincode response (first 300 chars): {pincode_resp.text[:300]}")
-    pincode_data = pincode_resp.json()
+
+
+def _parse_pincode_records(pincode, pincode_data):
+    """Return (raw_substore, normalized_substore, substore_id) for a pincode lookup."""
     records = pincode_data.get("records", [])
     if not records:
         logger.error(f"[SESSION] No substore found for pincode {pincode}")
-        raise Exception(f"No substore found for pincode {pincode}")
+        raise PincodeNotServiceableError(f"No substore found for pincode {pincode}")
     substore = records[0]["substore"]
     substore_id = records[0]["_id"]
     # Store raw substore for preferences
@@ -124,15 +148,79 @@ def get_tid_and_substore(session, pincode):
             "alias": str(substore),
             "name": str(substore).title() or f"Unknown-{substore_id}",
         }
+    return raw_substore, substore, substore_id
+
+
+def _preference_headers(headers, tid_header, cookies):
     pref_headers = headers.copy()
     pref_headers["content-type"] = "application/json"
     pref_headers["x-requested-with"] = "XMLHttpRequest"
     pref_headers["sec-fetch-mode"] = "cors"
     pref_headers["sec-fetch-site"] = "same-origin"
     pref_headers["tid"] = tid_header
-    cookie_str = "; ".join([f"{k}={v}" for k, v in session.cookies.get_dict().items()])
+    cookie_str = "; ".join([f"{k}={v}" for k, v in cookies.items()])
     if cookie_str:
         pref_headers["cookie"] = cookie_str
+    return pref_headers
+
+
+def _parse_info_js(pincode, text, substore_id):
+    """Extract (tid, substore_id) from the info.js session payload."""
+    tid_match = re.search(r"session\s*=\s*(\{.*\})", text, re.DOTALL)
+    if not tid_match:
+        logger.error(
+            f"[SESSION] Could not extract session JSON from info.js for pincode {pincode}"
+        )
+        raise Exception("Could not extract session JSON from info.js")
+    session_data = json.loads(tid_match.group(1))
+    tid = session_data.get("tid")
+    js_substore_id = session_data.get("substore_id")
+    js_substore_obj = session_data.get("substore", {})
+    if js_substore_id:
+        substore_id = js_substore_id
+    elif js_substore_obj:
+        substore_id = js_substore_obj.get("_id", substore_id)
+    if not tid or not substore_id:
+        logger.error(
+            f"[SESSION] tid or substore_id not found in info.js JSON for pincode {pincode}"
+        )
+        raise Exception("tid or substore_id not found in info.js JSON")
+    return tid, substore_id
+
+
+def _is_cloudflare_challenge(status, headers, text):
+    if headers.get("cf-mitigated") == "challenge":
+        return True
+    return status in (403, 503) and (
+        "cf-chl" in text or "Just a moment" in text or "challenge-platform" in text
+    )
+
+
+def get_tid_and_substore(session, pincode):
+    logger.info(f"[SESSION] Creating session and substore for pincode: {pincode}")
+    headers = _bootstrap_headers()
+    browse_url = f"{BASE_URL}/en/browse/protein"
+    logger.info(f"[SESSION] Visiting browse URL: {browse_url}")
+    browse_resp = session.get(browse_url, headers=headers, timeout=10)
+    logger.info(f"[SESSION] /en/browse/protein status: {browse_resp.status_code}")
+    # logger.info(f"[SESSION] /en/browse/protein response (first 300 chars): {browse_resp.text[:300]}")
+    pincode_params = _pincode_params(pincode)
+    dummy_tid = "dummy"
+    tid_header = calculate_tid_header(dummy_tid)
+    pincode_headers = headers.copy()
+    pincode_headers["referer"] = BASE_URL + "/"
+    pincode_headers["tid"] = tid_header
+    pincode_url = PINCODE_URL + "?" + urlencode(pincode_params)
+    logger.info(f"[SESSION] Looking up substore for pincode: {pincode_url}")
+    pincode_resp = session.get(
+        PINCODE_URL, headers=pincode_headers, params=pincode_params, timeout=10
+    )
+    logger.info(f"[SESSION] /entity/pincode status: {pincode_resp.status_code}")
+    _check_pincode_status(pincode, pincode_resp.status_code)
+    # logger.info(f"[SESSION] /entity/pincode response (first 300 chars): {pincode_resp.text[:300]}")
+    pincode_data = pincode_resp.json()
+    raw_substore, substore, substore_id = _parse_pincode_records(pincode, pincode_data)
+    pref_headers = _preference_headers(headers, tid_header, session.cookies.get_dict())
     pref_payload = {"data": {"store": raw_substore}}
     pref_url = SETTINGS_URL
     logger.info(f"[SESSION] Setting preferences for substore: {raw_substore}")
@@ -145,7 +233,9 @@ def get_tid_and_substore(session, pincode):
         logger.error(
             f"[SESSION] 406 Not Acceptable for setPreferences with payload: {json.dumps(pref_payload)}"
         )
-        raise Exception(f"setPreferences failed with 406 for pincode {pincode}")
+        raise PincodeLookupError(
+            f"setPreferences failed with 406 for pincode {pincode}"
+        )
     info_url = f"{INFO_URL}?_v={int(time.time() * 1000)}"
     logger.info(f"[SESSION] Fetching info.js for session data: {info_url}")
     info_js = session.get(info_url, headers=headers, timeout=10)
@@ -153,29 +243,110 @@ def get_tid_and_substore(session, pincode):
     logger.info(
         f"[SESSION] /user/info.js response (first 300 chars): {info_js.text[:300]}"
     )
-    tid_match = re.search(r"session\s*=\s*(\{.*\})", info_js.text, re.DOTALL)
-    if not tid_match:
-        logger.error(
-            f"[SESSION] Could not extract session JSON from info.js for pincode {pincode}"
-        )
-        raise Exception("Could not extract session JSON from info.js")
-    session_data = json.loads(tid_match.group(1))
-    tid = session_data.get("tid")
-    js_substore_id = session_data.get("substore_id")
-    js_substore_obj = session_data.get("substore", {})
-    if js_substore_id:
-        substore_id = js_substore_id
-    elif js_substore_obj:
-        substore_id = js_substore_obj.get("_id", substore_id)
-    if not tid or not substore_id:
-        logger.error(
-            f"[SESSION] tid or substore_id not found in info.js JSON for pincode {pincode}"
-        )
-        raise Exception("tid or substore_id not found in info.js JSON")
+    tid, substore_id = _parse_info_js(pincode, info_js.text, substore_id)
     logger.info(f"[SESSION] Session created: tid={tid}, substore_id={substore_id}")
     return tid, substore, substore_id, session.cookies.get_dict()
 
 
+async def get_tid_and_substore_async(session, pincode):
+    """Async counterpart of get_tid_and_substore built on an aiohttp session.
+
+    The session must have its own cookie jar, since the browse, pincode and
+    setPreferences calls accumulate the cookies that info.js needs. Raises
+    CloudflareChallengeError when a challenge page is served instead of data.
+    """
+    logger.info(f"[SESSION] Creating async session and substore for pincode: {pincode}")
+    headers = _bootstrap_headers()
+    timeout = aiohttp.ClientTimeout(total=10)
+    browse_url = f"{BASE_URL}/en/browse/protein"
+    logger.info(f"[SESSION] Visiting browse URL: {browse_url}")
+    await rate_limiters["browse"].wait()
+    async with session.get(browse_url, headers=headers, timeout=timeout) as resp:
+        text = await resp.text()
+        logger.info(f"[SESSION] /en/browse/protein status: {resp.status}")
+        if _is_cloudflare_challenge(resp.status, resp.headers, text):
+            raise CloudflareChallengeError(
+                f"Cloudflare challenge on browse page for pincode {pincode}"
+            )
+    pincode_params = _pincode_params(pincode)
+    tid_header = calculate_tid_header("dummy")
+    pincode_headers = headers.copy()
+    pincode_headers["referer"] = BASE_URL + "/"
+    pincode_headers["tid"] = tid_header
+    logger.info(
+        f"[SESSION] Looking up substore for pincode: {PINCODE_URL}?{urlencode(pincode_params)}"
+    )
+    await rate_limiters["pincode"].wait()
+    async with session.get(
+        PINCODE_URL, headers=pincode_headers, params=pincode_params, timeout=timeout
+    ) as resp:
+        text = await resp.text()
+        logger.info(f"[SESSION] /entity/pincode status: {resp.status}")
+        if _is_cloudflare_challenge(resp.status, resp.headers, text):
+            raise CloudflareChallengeError(
+                f"Cloudflare challenge on pincode lookup for pincode {pincode}"
+            )
+        _check_pincode_status(pincode, resp.status)
+        pincode_data = json.loads(text)
+    raw_substore, substore, substore_id = _parse_pincode_records(pincode, pincode_data)
+    cookies = _cookie_jar_dict(session.cookie_jar)
+    pref_headers = _preference_headers(headers, tid_header, cookies)
+    pref_payload = {"data": {"store": raw_substore}}
+    logger.info(f"[SESSION] Setting preferences for substore: {raw_substore}")
+    await rate_limiters["settings"].wait()
+    async with session.put(
+        SETTINGS_URL,
+        headers=pref_headers,
+        data=json.dumps(pref_payload),
+        timeout=timeout,
+    ) as resp:
+        await resp.read()
+        logger.info(f"[SESSION] setPreferences status: {resp.status}")
+        if resp.status == 406:
+            logger.error(
+                f"[SESSION] 406 Not Acceptable for setPreferences with payload: {json.dumps(pref_payload)}"
+            )
+            raise PincodeLookupError(
+                f"setPreferences failed with 406 for pincode {pincode}"
+            )
+    info_url = f"{INFO_URL}?_v={int(time.time() * 1000)}"
+    logger.info(f"[SESSION] Fetching info.js for session data: {info_url}")
+    await rate_limiters["info"].wait()
+    async with session.get(info_url, headers=headers, timeout=timeout) as resp:
+        text = await resp.text()
+        logger.info(f"[SESSION] /user/info.js status: {resp.status}")
+        logger.info(f"[SESSION] /user/info.js response (first 300 chars): {text[:300]}")
+        if _is_cloudflare_challenge(resp.status, resp.headers, text):
+            raise CloudflareChallengeError(
+                f"Cloudflare challenge on info.js for pincode {pincode}"
+            )
+    tid, substore_id = _parse_info_js(pincode, text, substore_id)
+    logger.info(f"[SESSION] Session created: tid={tid}, substore_id={substore_id}")
+    return tid, substore, substore_id, _cookie_jar_dict(session.cookie_jar)
+
+
+def _cookie_jar_dict(cookie_jar):
+    return {cookie.key: cookie.value for cookie in cookie_jar}
+
+
+async def bootstrap_session(pincode):
+    """Negotiate a tid/substore session for a pincode without blocking the loop.
+
+    Uses the native aiohttp bootstrap and only falls back to cloudscraper,
+    run in a worker thread, when Cloudflare serves a challenge page.
+    Returns the same (tid, substore, substore_id, cookies) tuple as
+    get_tid_and_substore and raises the same errors.
+    """
+    try:
+        async with create_isolated_session() as session:
+            return await get_tid_and_substore_async(session, pincode)
+    except CloudflareChallengeError as e:
+        logger.warning(f"[SESSION] {e}. Falling back to cloudscraper in a thread.")
+        return await asyncio.to_thread(
+            get_tid_and_substore, cloudscraper.create_scraper(), pincode
+        )
+
+
 def fetch_product_data_for_alias(session, tid, substore_id, alias):
     calc_tid = calculate_tid_header(tid)
     headers = {
@@ -215,10 +386,7 @@ def fetch_product_data_for_alias(session, tid, substore_id, alias):
         return []
 
 
-async def fetch_product_data_for_alias_async(
-    session, tid, substore_id, alias, semaphore, cookies=None, max_retries=3
-):
-    calc_tid = calculate_tid_header(tid)
+def _product_api_headers(tid, cookies=None):
     headers = {
         "user-agent": API_HEADERS["user-agent"],
         "accept": "application/json, text/plain, */*",
@@ -226,27 +394,48 @@ async def fetch_product_data_for_alias_async(
         "origin": BASE_URL,
         "accept-language": "en-US,en;q=0.9",
         "x-amul-b2c-access-key": "shop.amul.com",
-        "tid": calc_tid,
+        "tid": calculate_tid_header(tid),
     }
     if cookies:
         cookie_str = "; ".join([f"{k}={v}" for k, v in cookies.items()])
         if cookie_str:
             headers["cookie"] = cookie_str
+    return headers
+
+
+async def fetch_product_data_for_alias_async(
+    session, tid, substore_id, alias, semaphore, cookies=None, max_retries=3
+):
+    headers = _product_api_headers(tid, cookies)
+    headers.update(product_response_cache.conditional_headers(substore_id, alias))
     query = {"q": json.dumps({"alias": alias}), "limit": 1}
     product_url = API_URL + "?" + urlencode(query)
     for attempt in range(1, max_retries + 1):
         async with semaphore:
             await product_api_rate_limiter.wait()
-            await asyncio.sleep(random.uniform(*PRODUCT_API_DELAY_RANGE))
+            started = time.monotonic()
             try:
                 async with session.get(
                     API_URL, headers=headers, params=query, timeout=10
                 ) as resp:
                     text = await resp.text()
+                    await product_api_controller.record(
+                        substore_id, resp.status, time.monotonic() - started
+                    )
                     logger.info(
                         f"[SESSION] Product API status for alias '{alias}': {resp.status}"
                     )
                     # logger.info(f"[SESSION] Product API response for alias '{alias}' (first 300 chars): {text[:300]}")
+                    if resp.status == 304:
+                        cached = product_response_cache.get_body(substore_id, alias)
+                        if cached is not None:
+                            logger.info(f"[SESSION] Alias '{alias}' not modified")
+                            product_response_cache.mark_unchanged(substore_id, [alias])
+                            return cached
+                        # No body to fall back on: ask again unconditionally
+                        headers.pop("if-none-match", None)
+                        headers.pop("if-modified-since", None)
+                        continue
                     if resp.status == 401:
                         logger.warning(
                             f"401 Unauthorized for alias '{alias}', attempt {attempt}"
@@ -276,7 +465,11 @@ async def fetch_product_data_for_alias_async(
                         continue
                     try:
                         data = await resp.json()
-                        return data.get("data", [])
+                        records = data.get("data", [])
+                        await product_response_cache.store(
+                            substore_id, alias, resp.headers, records
+                        )
+                        return records
                     except Exception as e:
                         logger.error(
                             f"[SESSION] Error parsing product API response for alias '{alias}': {str(e)}"
@@ -286,6 +479,9 @@ async def fetch_product_data_for_alias_async(
                 logger.error(
                     f"[SESSION] Network error for alias '{alias}', attempt {attempt}: {str(e)}"
                 )
+                await product_api_controller.record(
+                    substore_id, None, time.monotonic() - started
+                )
                 await asyncio.sleep(2**attempt)
     logger.error(
         f"[SESSION] Failed to fetch product data for alias '{alias}' after {max_retries} attempts."
@@ -293,6 +489,120 @@ async def fetch_product_data_for_alias_async(
     return []
 
 
+async def fetch_products_for_aliases_async(
+    session,
+    tid,
+    substore_id,
+    aliases,
+    semaphore,
+    cookies=None,
+    max_retries=3,
+    page_size=PRODUCT_API_BATCH_PAGE_SIZE,
+):
+    """Fetch several product aliases with a single `$in` query.
+
+    Pages through the results with `start` in case the server caps `limit`.
+    Returns a dict of alias -> list of product records for every alias that
+    was present in the response, or None on 401 so the caller can refresh
+    the session.  Aliases missing from the dict should be fetched one by one.
+    """
+    aliases = list(dict.fromkeys(aliases))
+    records_by_alias = {}
+    if not aliases:
+        return records_by_alias
+    q = json.dumps({"alias": {"$in": aliases}})
+    start = 0
+    while True:
+        query = {"q": q, "limit": page_size, "start": start}
+        cache_key = (
+            f"batch:{hashlib.sha1(q.encode('utf-8')).hexdigest()}:{page_size}:{start}"
+        )
+        conditional_headers = product_response_cache.conditional_headers(
+            substore_id, cache_key
+        )
+        page = None
+        for attempt in range(1, max_retries + 1):
+            async with semaphore:
+                await product_api_rate_limiter.wait()
+                started = time.monotonic()
+                try:
+                    headers = _product_api_headers(tid, cookies)
+                    headers.update(conditional_headers)
+                    async with session.get(
+                        API_URL, headers=headers, params=query, timeout=10
+                    ) as resp:
+                        await product_api_controller.record(
+                            substore_id, resp.status, time.monotonic() - started
+                        )
+                        logger.info(
+                            f"[SESSION] Batch product API status for {len(aliases)} aliases (start={start}): {resp.status}"
+                        )
+                        if resp.status == 304:
+                            page = product_response_cache.get_body(
+                                substore_id, cache_key
+                            )
+                            if page is not None:
+                                product_response_cache.mark_unchanged(
+                                    substore_id,
+                                    [r.get("alias") for r in page.get("data", [])],
+                                )
+                                break
+                            conditional_headers = {}
+                            continue
+                        if resp.status == 401:
+                            logger.warning(
+                                f"401 Unauthorized for batch product fetch, attempt {attempt}"
+                            )
+                            return None
+                        if resp.status == 406 or resp.status >= 500:
+                            logger.warning(
+                                f"Status {resp.status} for batch product fetch, attempt {attempt}"
+                            )
+                            await asyncio.sleep(2**attempt)
+                            continue
+                        try:
+                            page = await resp.json()
+                            await product_response_cache.store(
+                                substore_id, cache_key, resp.headers, page
+                            )
+                        except Exception as e:
+                            logger.error(
+                                f"[SESSION] Error parsing batch product API response: {str(e)}"
+                            )
+                            page = {}
+                        break
+                except Exception as e:
+                    logger.error(
+                        f"[SESSION] Network error for batch product fetch, attempt {attempt}: {str(e)}"
+                    )
+                    await product_api_controller.record(
+                        substore_id, None, time.monotonic() - started
+                    )
+                    await asyncio.sleep(2**attempt)
+        if page is None:
+            logger.error(
+                f"[SESSION] Batch product fetch failed after {max_retries} attempts at start={start}"
+            )
+            break
+        if not isinstance(page, dict):
+            page = {}
+        data = page.get("data", [])
+        for record in data:
+            alias = record.get("alias")
+            if alias in aliases:
+                records_by_alias.setdefault(alias, []).append(record)
+        total = (page.get("paging") or {}).get("total")
+        start += len(data)
+        if len(data) < page_size or (isinstance(total, int) and start >= total):
+            break
+        if len(records_by_alias) == len(aliases):
+            break
+    logger.info(
+        f"[SESSION] Batch product fetch returned {len(records_by_alias)}/{len(aliases)} aliases"
+    )
+    return records_by_alias
+
+
 def calculate_tid_header(session_tid):
     store_id = "62fa94df8c13af2e242eba16"
     timestamp = str(int(time.time() * 1000))
@@ -0,0 +1,110 @@
+"""Benchmark the user-to-notification fan-out in product_checker.
+
+Builds synthetic state groups and times build_product_masks plus
+build_user_notifications at growing subscriber counts. The per-user cost should stay flat as the count grows.
+The legacy chat_id lookup (a scan of every state group per notified user)
+is timed alongside it for comparison on the smaller sizes.
+
+Usage: python bench_fanout.py [user_count ...]
+"""
+
+import asyncio
+import logging
+import random
+import sys
+import time
+
+from common import PRODUCTS
+from product_checker import build_product_masks, build_user_notifications
+
+STATE_COUNT = 20
+LEGACY_MAX_USERS = 20000
+DEFAULT_SIZES = [5000, 10000, 20000, 50000, 100000]
+PREFERENCES = ["until_stop", "once_and_stop", "once_per_restock"]
+
+
+def make_state_groups(user_count, rng):
+    state_groups = {f"state-{i}": [] for i in range(STATE_COUNT)}
+    states = list(state_groups)
+    for chat_id in range(1, user_count + 1):
+        products = (
+            ["Any"] if rng.random() < 0.2 else rng.sample(PRODUCTS, rng.randint(1, 6))
+        )
+        state_groups[states[chat_id % STATE_COUNT]].append(
+            {
+                "chat_id": str(chat_id),
+                "pincode": str(110000 + chat_id % 900),
+                "products": products,
+                "notification_preference": rng.choice(PREFERENCES),
+                "active": True,
+                "last_notified": {},
+            }
+        )
+    return state_groups
+
+
+def make_state_results(state_groups, rng):
+    return {
+        state_alias: (
+            [
+                (name, "In Stock" if rng.random() < 0.5 else "Sold Out", 10)
+                for name in PRODUCTS
+            ],
+            {},
+        )
+        for state_alias in state_groups
+    }
+
+
+def legacy_lookup(state_groups, chat_ids):
+    for chat_id in chat_ids:
+        next(
+            (
+                u
+                for users in state_groups.values()
+                for u in users
+                if str(u.get("chat_id")) == str(chat_id)
+            ),
+            None,
+        )
+
+
+async def run(sizes):
+    rng = random.Random(42)
+    print(
+        f"{'users':>8} {'notified':>9} {'fan-out s':>10} {'us/user':>8} {'legacy s':>9}"
+    )
+    for user_count in sizes:
+        state_groups = make_state_groups(user_count, rng)
+        state_results = make_state_results(state_groups, rng)
+
+        start = time.perf_counter()
+        product_masks = build_product_masks(
+            user for users in state_groups.values() for user in users
+        )
+        notifications = await build_user_notifications(
+            state_groups, state_results, None, product_masks
+        )
+        elapsed = time.perf_counter() - start
+
+        legacy = "-"
+        if user_count <= LEGACY_MAX_USERS:
+            start = time.perf_counter()
+            legacy_lookup(state_groups, notifications)
+            legacy = f"{time.perf_counter() - start:.2f}"
+
+        print(
+            f"{user_count:>8} {len(notifications):>9} {elapsed:>10.2f} "
+            f"{elapsed / user_count * 1e6:>8.1f} {legacy:>9}"
+        )
+
+
+def main():
+    # should_notify_user logs every decision; keep that out of the timings
+    logging.disable(logging.CRITICAL)
+    sizes = [int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES
+    asyncio.run(run(sizes))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+import asyncio
+import logging
+import time
+
+from telegram.error import TelegramError
+
+from config import BROADCAST_CHUNK_SIZE, BROADCAST_PROGRESS_INTERVAL
+from database import MIN_CHAT_ID
+from send_scheduler import telegram_scheduler, SENT, BLOCKED
+from sentry_utils import create_task_catching
+
+logger = logging.getLogger(__name__)
+
+# Keep references so running broadcast tasks are not garbage collected
+_running_tasks = set()
+
+
+class BroadcastWorker:
+    """Sends one broadcast by streaming recipients from the database.
+
+    Recipients are fetched BROADCAST_CHUNK_SIZE chat_ids at a time and each
+    chunk is sent concurrently through the shared Telegram send scheduler,
+    which keeps the bot under the platform rate limits. After every chunk
+    the cursor (last chat_id) and the delivered/blocked/failed counts are
+    persisted, so a broadcast interrupted by a restart resumes from its last
+    finished chunk.
+    """
+
+    def __init__(
+        self,
+        bot,
+        db,
+        broadcast_id,
+        admin_chat_id,
+        target_group,
+        text,
+        last_chat_id=MIN_CHAT_ID,
+        delivered=0,
+        blocked=0,
+        failed=0,
+        progress_message_id=None,
+        chunk_size=BROADCAST_CHUNK_SIZE,
+    ):
+        self.bot = bot
+        self.db = db
+        self.broadcast_id = broadcast_id
+        self.admin_chat_id = admin_chat_id
+        self.target_group = target_group
+        self.text = text
+        self.last_chat_id = last_chat_id
+        self.counts = {"delivered": delivered, "blocked": blocked, "failed": failed}
+        self.progress_message_id = progress_message_id
+        self.chunk_size = chunk_size
+        self._last_progress = 0.0
+
+    async def _send(self, chat_id):
+        outcome = await telegram_scheduler.send_message(
+            self.bot, chat_id, self.text, parse_mode="MarkdownV2"
+        )
+        if outcome == SENT:
+            self.counts["delivered"] += 1
+        elif outcome == BLOCKED:
+            self.counts["blocked"] += 1
+        else:
+            self.counts["failed"] += 1
+
+    def _progress_text(self):
+        return (
+            f"📢 Broadcast to {self.target_group} users in progress\n"
+            f"✅ Delivered: {self.counts['delivered']}\n"
+            f"🚫 Blocked: {self.counts['blocked']}\n"
+            f"❌ Failed: {self.counts['failed']}"
+        )
+
+    async def _report_progress(self, force=False):
+        if self.progress_message_id is None:
+            return
+        now = time.monotonic()
+        if not force and now - self._last_progress < BROADCAST_PROGRESS_INTERVAL:
+            return
+        self._last_progress = now
+        try:
+            await self.bot.edit_message_text(
+                chat_id=self.admin_chat_id,
+                message_id=self.progress_message_id,
+                text=self._progress_text(),
+            )
+        except TelegramError as e:
+            logger.debug(f"Could not update broadcast progress message: {e}")
+
+    async def _save(self, status="running"):
+        await self.db.update_broadcast(
+            self.broadcast_id,
+            self.last_chat_id,
+            self.counts["delivered"],
+            self.counts["blocked"],
+            self.counts["failed"],
+            status=status,
+        )
+
+    async def run(self):
+        start_time = time.monotonic()
+        logger.info(
+            f"Broadcast {self.broadcast_id} to {self.target_group} users started "
+            f"after chat_id {self.last_chat_id}"
+        )
+        try:
+            while True:
+                chat_ids = await self.db.get_broadcast_chat_ids(
+                    self.target_group, self.last_chat_id, self.chunk_size
+                )
+                if not chat_ids:
+                    break
+                await asyncio.gather(*(self._send(chat_id) for chat_id in chat_ids))
+                self.last_chat_id = chat_ids[-1]
+                await self._save()
+                await self._report_progress()
+        except asyncio.CancelledError:
+            # Leave the broadcast running so the next start resumes it
+            await self._save()
+            raise
+        except Exception as e:
+            logger.error(f"Broadcast {self.broadcast_id} stopped: {e}")
+            await self._save(status="interrupted")
+            await self._notify_admin(
+                f"⚠️ Broadcast {self.broadcast_id} stopped after "
+                f"{self.counts['delivered']} deliveries: {e}"
+            )
+            return
+
+        duration = time.monotonic() - start_time
+        await self._save(status="completed")
+        await self._report_progress(force=True)
+        total = sum(self.counts.values())
+        await self._notify_admin(
+            f"✅ Broadcast completed! It took {duration:.2f} seconds for {total} "
+            f"{self.target_group} users.\n"
+            f"Delivered: {self.counts['delivered']}, "
+            f"blocked: {self.counts['blocked']}, failed: {self.counts['failed']}."
+        )
+        logger.info(
+            f"Broadcast {self.broadcast_id} completed in {duration:.2f}s: {self.counts}"
+        )
+
+    async def _notify_admin(self, text):
+        try:
+            await self.bot.send_message(chat_id=self.admin_chat_id, text=text)
+        except TelegramError as e:
+            logger.error(
+                f"Failed to send broadcast status to admin {self.admin_chat_id}: {e}"
+            )
+
+
+def start_broadcast(worker):
+    """Run a BroadcastWorker in the background."""
+    task = create_task_catching(worker.run())
+    _running_tasks.add(task)
+    task.add_done_callback(_running_tasks.discard)
+    return task
+
+
+async def resume_broadcasts(bot, db):
+    """Restart broadcasts that were interrupted by a bot restart."""
+    for broadcast in await db.get_running_broadcasts():
+        logger.info(
+            f"Resuming broadcast {broadcast['id']} after chat_id {broadcast['last_chat_id']}"
+        )
+        start_broadcast(
+            BroadcastWorker(
+                bot,
+                db,
+                broadcast["id"],
+                broadcast["admin_chat_id"],
+                broadcast["target_group"],
+                broadcast["message"],
+                last_chat_id=broadcast["last_chat_id"],
+                delivered=broadcast["delivered"],
+                blocked=broadcast["blocked"],
+                failed=broadcast["failed"],
+            )
+        )
@@ -203,6 +203,39 @@ CATEGORIES = list(CATEGORIZED_PRODUCTS.keys())
 # Short to full mapping (reverse of product_name_map)
 SHORT_TO_FULL = {v: k for k, v in PRODUCT_NAME_MAP.items()}
 
+# Bit position of each product in a subscription bitmask ("Any" has no bit)
+PRODUCT_BITS = {name: 1 << index for index, name in enumerate(PRODUCTS)}
+ALL_PRODUCTS_MASK = (1 << len(PRODUCTS)) - 1
+
+
+def is_any_subscription(products):
+    """Return True if a products list means "track every product"."""
+    return len(products) == 1 and str(products[0]).strip().lower() == "any"
+
+
+def products_to_mask(products):
+    """Convert a user's products list to a subscription bitmask.
+
+    "Any" maps to every bit. Names missing from the catalog are ignored.
+    """
+    if not products:
+        return 0
+    if is_any_subscription(products):
+        return ALL_PRODUCTS_MASK
+    mask = 0
+    for name in products:
+        mask |= PRODUCT_BITS.get(name, 0)
+    return mask
+
+
+def status_mask(product_status, status="In Stock"):
+    """Return the bitmask of products in product_status with the given status."""
+    mask = 0
+    for name, product_state, _ in product_status:
+        if product_state == status:
+            mask |= PRODUCT_BITS.get(name, 0)
+    return mask
+
 
 def get_product_info(identifier, return_field="display_name", search_by="name"):
     """
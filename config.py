@@ -9,6 +9,7 @@ DATABASE_URL = os.getenv("DATABASE_URL")  # PostgreSQL connection string (requir
 DATABASE_FILE = os.getenv(
     "DATABASE_FILE", "users.db"
 )  # SQLite file path (optional, for migration)
+USER_QUERY_CHUNK_SIZE = 1000  # Users fetched per keyset-paginated query
 # --- Secrets and Environment-Specific ---
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 ADMIN_CHAT_ID = os.getenv("ADMIN_CHAT_ID")
@@ -23,6 +24,42 @@ NOTIFICATION_CONCURRENCY_LIMIT = int(
     os.getenv("NOTIFICATION_CONCURRENCY_LIMIT", 30)
 )  # Default to 30 for Telegram limit
 MAX_RETRY = 1
+# Telegram allows about 30 messages/s per bot and one message/s per chat
+TELEGRAM_GLOBAL_RATE = 30
+TELEGRAM_GLOBAL_BURST = 1
+TELEGRAM_PER_CHAT_INTERVAL = 1.0  # seconds
+TELEGRAM_SEND_RETRIES = 3
+TELEGRAM_SEND_TIMEOUT = 10  # seconds per attempt
+# Longest total RetryAfter wait for one message before it is given up
+TELEGRAM_MAX_RETRY_AFTER_WAIT = 300  # seconds
+BROADCAST_CHUNK_SIZE = 500  # Recipients fetched and sent per chunk
+BROADCAST_PROGRESS_INTERVAL = 10  # Min seconds between progress message edits
+# Stream each state's results into notification dispatch as soon as it finishes
+NOTIFICATION_PIPELINE_ENABLED = True
+PIPELINE_STATE_QUEUE_SIZE = 8
+PIPELINE_NOTIFICATION_QUEUE_SIZE = 500
+LAST_NOTIFIED_FLUSH_BATCH_SIZE = 500  # Users per bulk last_notified write
+LAST_NOTIFIED_FLUSH_RETRIES = 3
+# Max seconds an update waits in memory, bounding what a hard crash loses
+LAST_NOTIFIED_FLUSH_INTERVAL = 10
+# Seconds between scheduled product checks (the cron in .github/workflows)
+CHECK_INTERVAL = 6 * 3600
+# Queue notifications in a Postgres outbox and deliver them from it. Off by
+# default: the in-memory pipeline above is the normal path. Enable it when a
+# crashed run is re-run by hand and should resume its undelivered sends.
+NOTIFICATION_OUTBOX_ENABLED = (
+    os.getenv("NOTIFICATION_OUTBOX_ENABLED", "false").lower() == "true"
+)
+OUTBOX_CLAIM_BATCH_SIZE = 20  # Rows a sender worker claims at a time
+OUTBOX_CLAIM_TIMEOUT = 300  # Seconds before an unfinished claim can be retaken
+OUTBOX_MAX_ATTEMPTS = 3
+# Undelivered rows older than this are expired, not sent. It is shorter than
+# CHECK_INTERVAL so the next scheduled run, which detects stock afresh, drops
+# a crashed run's leftovers instead of sending stale alerts; only a re-run
+# within this window resumes them.
+OUTBOX_MAX_AGE = CHECK_INTERVAL // 2
+OUTBOX_POLL_INTERVAL = 5  # Max seconds an idle worker waits for newly queued rows
+OUTBOX_RETENTION_DAYS = 2
 
 # --- File Paths ---
 LOG_FILE = "product_check.log"
@@ -36,7 +73,8 @@ SETTINGS_URL = f"{BASE_URL}/entity/ms.settings/_/setPreferences"
 INFO_URL = f"{BASE_URL}/user/info.js"
 
 # Session management
-COOKIE_REFRESH_INTERVAL = 1200
+COOKIE_REFRESH_INTERVAL = 1200  # Session cache TTL in seconds
+SESSION_REFRESH_MARGIN = 120  # Refresh cached sessions this many seconds before expiry
 
 # API Headers
 API_HEADERS = {
@@ -57,14 +95,55 @@ API_HEADERS = {
     "content-type": "application/json",
 }
 
+# --- Shared HTTP connection pool ---
+HTTP_POOL_LIMIT = 100
+HTTP_POOL_LIMIT_PER_HOST = 20
+HTTP_DNS_CACHE_TTL = 600  # seconds
+HTTP_KEEPALIVE_TIMEOUT = 60  # seconds
+
 # --- Substore Mapping ---
 USE_SUBSTORE_CACHE = True
 FALLBACK_TO_PINCODE_CACHE = True
-SUBSTORE_LIST_FILE = "substore_list.py"
+SUBSTORE_MAPPING_FILE = "substore_mapping.json"
+SUBSTORE_JOURNAL_FILE = "substore_mapping.journal"  # New pincodes since compaction
+SUBSTORE_JOURNAL_COMPACT_SIZE = 200  # Journal entries before compacting
+# Assign unknown pincodes to the only state seen under their postal prefix,
+# confirming the lookup in the background
+PINCODE_PREFIX_INFERENCE = True
+# Unknown pincodes bootstrapped at once when mapping them to substores
+PINCODE_RESOLVE_CONCURRENCY = 4
+# Negative cache for pincodes without a substore or with repeated lookup
+# errors: re-checks back off exponentially from the base TTL up to the max
+PINCODE_NEGATIVE_TTL = 6 * 3600  # seconds
+PINCODE_NEGATIVE_MAX_TTL = 7 * 24 * 3600  # seconds
+PINCODE_ERROR_THRESHOLD = 3  # Lookup errors in a row before a pincode is cached
+SUBSTORE_LIST_FILE = "substore_list.py"  # Legacy format, converted on first load
 
 # --- Rate Limiting Settings ---
-PRODUCT_API_DELAY_RANGE = (1.0, 2.0)
 GLOBAL_PRODUCT_API_RPS = 5
+# Token bucket per endpoint: (requests per second, burst size)
+API_RATE_LIMITS = {
+    "products": (GLOBAL_PRODUCT_API_RPS, 10),
+    "browse": (2, 4),
+    "pincode": (2, 4),
+    "settings": (2, 4),
+    "info": (2, 4),
+}
+# Fetch all tracked aliases with one `$in` query per substore, falling back to
+# per-alias requests only for aliases missing from the batch response
+PRODUCT_API_BATCH_FETCH = True
+PRODUCT_API_BATCH_PAGE_SIZE = 50
+
+# --- Adaptive Concurrency (AIMD) for product API fetches ---
+# SEMAPHORE_LIMIT is the starting per-substore concurrency; the controller
+# grows it on fast 2xx responses and halves it on 406/429/5xx.
+ADAPTIVE_CONCURRENCY_ENABLED = True
+ADAPTIVE_MIN_CONCURRENCY = 1
+ADAPTIVE_MAX_CONCURRENCY = 8
+ADAPTIVE_GLOBAL_CONCURRENCY = 16
+ADAPTIVE_MIN_RPS = 1.0
+ADAPTIVE_MAX_RPS = 20.0
+ADAPTIVE_BACKOFF_FACTOR = 0.5
 
 # --- Logging and Monitoring ---
 MAX_FILE_SIZE = 100 * 1024 * 1024  # 100 MB
@@ -1,12 +1,64 @@
 import asyncpg
+import hashlib
 import logging
 import asyncio
 from datetime import datetime, timedelta
-from config import DATABASE_URL
+from config import DATABASE_URL, USER_QUERY_CHUNK_SIZE
 import json  # Added for potential loads
 
 logger = logging.getLogger(__name__)
 
+# Active users with a pincode and at least one product. Shared by the checker
+# query and the partial index so the planner can always use the index.
+CHECKER_USER_FILTER = """
+    data->'active' = 'true'::jsonb
+    AND COALESCE(data->>'pincode', '') <> ''
+    AND COALESCE(data->>'products', '[]') NOT IN ('[]', '""')
+"""
+
+# Keyset cursor start below every chat_id; group chats have negative ids
+MIN_CHAT_ID = -(2**63)
+
+# Recipient filters for /broadcast target groups, on the typed users columns
+BROADCAST_TARGET_FILTERS = {
+    "all": "TRUE",
+    "active": "active",
+    "inactive": "NOT active",
+}
+
+# Derive the typed user columns from users.data. The {where} filter on users
+# lets the same SQL serve the one-off backfill (no filter) and the per-user
+# dual-write.
+USER_COLUMN_FIELDS = ("pincode", "active", "notification_preference")
+SYNC_USER_COLUMNS_SQL = """
+    UPDATE users SET
+        pincode = NULLIF(data->>'pincode', ''),
+        active = COALESCE(data->'active' = 'true'::jsonb, FALSE),
+        notification_preference = COALESCE(
+            data->>'notification_preference', 'until_stop'
+        )
+    {where}
+"""
+# Casts that return NULL instead of failing the whole statement, so one
+# malformed users.data value cannot abort a last_notified merge.
+# Created only when missing so concurrent starts do not race on the catalog.
+SAFE_CAST_FUNCTIONS_SQL = """
+    DO $do$
+    BEGIN
+        IF to_regprocedure('try_jsonb(text)') IS NULL THEN
+            CREATE FUNCTION try_jsonb(value TEXT) RETURNS JSONB
+            LANGUAGE plpgsql IMMUTABLE AS $fn$
+            BEGIN
+                RETURN value::jsonb;
+            EXCEPTION WHEN others THEN
+                RETURN NULL;
+            END
+            $fn$;
+        END IF;
+    END
+    $do$
+"""
+
 
 class Database:
     def __init__(self, db_url):
@@ -81,11 +133,127 @@ class Database:
                     last_cleanup_timestamp TEXT NOT NULL
                 )
             """)
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS api_sessions (
+                    substore_id TEXT PRIMARY KEY,
+                    pincode TEXT NOT NULL,
+                    tid TEXT NOT NULL,
+                    substore JSONB NOT NULL,
+                    cookies JSONB NOT NULL,
+                    created_at TEXT NOT NULL
+                )
+            """)
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS product_response_cache (
+                    substore_id TEXT NOT NULL,
+                    cache_key TEXT NOT NULL,
+                    etag TEXT,
+                    last_modified TEXT,
+                    body JSONB NOT NULL,
+                    updated_at TEXT NOT NULL,
+                    PRIMARY KEY (substore_id, cache_key)
+                )
+            """)
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS notification_outbox (
+                    id BIGSERIAL PRIMARY KEY,
+                    idempotency_key TEXT NOT NULL UNIQUE,
+                    chat_id BIGINT NOT NULL,
+                    state_alias TEXT NOT NULL,
+                    snapshot_id TEXT NOT NULL,
+                    products_to_check JSONB NOT NULL,
+                    notify_products JSONB NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    last_error TEXT,
+                    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    claimed_at TIMESTAMPTZ,
+                    finished_at TIMESTAMPTZ
+                )
+            """)
+            # At most one open notification per user and state
+            await conn.execute("""
+                CREATE UNIQUE INDEX IF NOT EXISTS idx_notification_outbox_open
+                ON notification_outbox (chat_id, state_alias)
+                WHERE status IN ('pending', 'sending')
+            """)
+            await conn.execute("""
+                CREATE INDEX IF NOT EXISTS idx_notification_outbox_claimable
+                ON notification_outbox (id)
+                WHERE status IN ('pending', 'sending')
+            """)
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS broadcasts (
+                    id BIGSERIAL PRIMARY KEY,
+                    admin_chat_id BIGINT NOT NULL,
+                    target_group TEXT NOT NULL,
+                    message TEXT NOT NULL,
+                    status TEXT NOT NULL DEFAULT 'running',
+                    last_chat_id BIGINT NOT NULL DEFAULT -9223372036854775808,
+                    delivered INTEGER NOT NULL DEFAULT 0,
+                    blocked INTEGER NOT NULL DEFAULT 0,
+                    failed INTEGER NOT NULL DEFAULT 0,
+                    created_at TEXT NOT NULL,
+                    updated_at TEXT NOT NULL,
+                    finished_at TEXT
+                )
+            """)
+            # Older tables defaulted to 0, which skipped group chats
+            await conn.execute(f"""
+                ALTER TABLE broadcasts
+                ALTER COLUMN last_chat_id SET DEFAULT {MIN_CHAT_ID}
+            """)
+            # Typed columns derived from users.data
+            await conn.execute("""
+                ALTER TABLE users
+                    ADD COLUMN IF NOT EXISTS pincode TEXT,
+                    ADD COLUMN IF NOT EXISTS active BOOLEAN NOT NULL DEFAULT FALSE,
+                    ADD COLUMN IF NOT EXISTS notification_preference TEXT
+            """)
+            # Normalized mirrors of products and last_notified that nothing read
+            await conn.execute(
+                "DROP TABLE IF EXISTS user_subscriptions, user_notifications"
+            )
+            # last_notified updates a run could not merge, for the next run
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS pending_last_notified (
+                    chat_id BIGINT NOT NULL,
+                    product TEXT NOT NULL,
+                    notified_at TEXT NOT NULL,
+                    PRIMARY KEY (chat_id, product)
+                )
+            """)
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    name TEXT PRIMARY KEY,
+                    applied_at TEXT NOT NULL
+                )
+            """)
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS pincode_negative_cache (
+                    pincode TEXT PRIMARY KEY,
+                    reason TEXT NOT NULL,
+                    failures INTEGER NOT NULL DEFAULT 1,
+                    last_error TEXT,
+                    checked_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                    retry_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+            """)
+            # Only served the removed get_active_subscribers query
+            await conn.execute("DROP INDEX IF EXISTS idx_users_pincode_active")
+            await conn.execute(SAFE_CAST_FUNCTIONS_SQL)
+            await self._backfill_user_columns(conn)
             # Add GIN index for JSONB queries on users.data
             await conn.execute("""
                 CREATE INDEX IF NOT EXISTS idx_users_data_gin
                 ON users USING GIN (data)
             """)
+            # Partial index matching the checker's user query
+            await conn.execute(f"""
+                CREATE INDEX IF NOT EXISTS idx_users_checker
+                ON users (chat_id)
+                WHERE {CHECKER_USER_FILTER}
+            """)
             logging.info("Database tables and indexes created successfully")
         except asyncpg.exceptions.PostgresError as e:
             logging.error(f"Error creating tables: {e}")
@@ -186,6 +354,33 @@ class Database:
 
         return data
 
+    async def _backfill_user_columns(self, conn):
+        """Fill the typed user columns from users.data once."""
+        async with conn.transaction():
+            # Concurrent starts block on the marker row until this commits
+            claimed = await conn.fetchval(
+                """
+                INSERT INTO schema_migrations (name, applied_at)
+                VALUES ('backfill_normalized_users', $1)
+                ON CONFLICT (name) DO NOTHING
+                RETURNING name
+            """,
+                datetime.now().isoformat(),
+            )
+            if not claimed:
+                return
+            await conn.execute(SYNC_USER_COLUMNS_SQL.format(where=""))
+            logging.info("Backfilled typed user columns from users.data")
+
+    async def _sync_user_columns(self, conn, chat_id):
+        """Mirror one user's JSONB document into the typed columns.
+
+        Must run in the transaction that wrote users.data.
+        """
+        await conn.execute(
+            SYNC_USER_COLUMNS_SQL.format(where="WHERE chat_id = $1"), chat_id
+        )
+
     async def get_user(self, chat_id):
         """Retrieve user data by chat_id."""
         try:
@@ -231,6 +426,7 @@ class Database:
                         chat_id,
                         user_json,
                     )
+                    await self._sync_user_columns(conn, chat_id)
                     logging.debug(f"Updated user {chat_id}")
                     # Transaction is automatically committed here
             return True
@@ -255,6 +451,8 @@ class Database:
                         path,
                         value_json,
                     )
+                    if path[0] in USER_COLUMN_FIELDS:
+                        await self._sync_user_columns(conn, chat_id)
                     logging.debug(f"Partial update for user {chat_id} at path {path}")
         except asyncpg.exceptions.PostgresError as e:
             logging.error(f"Error partial updating user {chat_id}: {e}")
@@ -277,6 +475,150 @@ class Database:
             logging.error(f"Error deleting user {chat_id}: {e}")
             raise
 
+    async def migrate_chat_id(self, old_chat_id, new_chat_id):
+        """Move a user whose group chat was migrated to a supergroup.
+
+        Returns True if the user was moved.
+        """
+        try:
+            old_chat_id = int(old_chat_id)
+            new_chat_id = int(new_chat_id)
+            async with self._pool.acquire() as conn:
+                result = await conn.execute(
+                    """
+                    UPDATE users
+                    SET chat_id = $2,
+                        data = jsonb_set(data, '{chat_id}', to_jsonb($2::text))
+                    WHERE chat_id = $1
+                """,
+                    old_chat_id,
+                    new_chat_id,
+                )
+            moved = result != "UPDATE 0"
+            if moved:
+                logging.info(f"Migrated user {old_chat_id} to chat {new_chat_id}")
+            return moved
+        except asyncpg.exceptions.UniqueViolationError:
+            logging.warning(
+                f"Chat {old_chat_id} migrated to {new_chat_id}, which already "
+                "has a user; keeping both"
+            )
+            return False
+        except asyncpg.exceptions.PostgresError as e:
+            logging.error(
+                f"Error migrating user {old_chat_id} to chat {new_chat_id}: {e}"
+            )
+            return False
+
+    async def iter_checker_users(self, chunk_size=USER_QUERY_CHUNK_SIZE):
+        """Stream active, configured users with only the fields the checker reads.
+
+        Users are fetched chunk_size at a time with keyset pagination on
+        chat_id (served by idx_users_checker). Each page is a separate query,
+        so no connection or transaction is held while the caller processes
+        the users. last_notified is only projected for the preferences that
+        use it.
+        """
+        last_chat_id = MIN_CHAT_ID
+        while True:
+            try:
+                async with self._pool.acquire() as conn:
+                    rows = await conn.fetch(
+                        f"""
+                        SELECT
+                            chat_id,
+                            data->>'pincode' AS pincode,
+                            data->'products' AS products,
+                            COALESCE(
+                                data->>'notification_preference', 'until_stop'
+                            ) AS notification_preference,
+                            CASE
+                                WHEN data->>'notification_preference'
+                                    IN ('once_and_stop', 'once_per_restock')
+                                THEN data->'last_notified'
+                            END AS last_notified
+                        FROM users
+                        WHERE {CHECKER_USER_FILTER}
+                        AND chat_id > $1
+                        ORDER BY chat_id
+                        LIMIT $2
+                    """,
+                        last_chat_id,
+                        chunk_size,
+                    )
+            except asyncpg.exceptions.PostgresError as e:
+                logging.error(f"Error streaming users for the checker: {e}")
+                return
+            if not rows:
+                return
+            last_chat_id = rows[-1]["chat_id"]
+            for row in rows:
+                user = self._checker_user_from_row(row)
+                if user:
+                    yield user
+            if len(rows) < chunk_size:
+                return
+
+    @staticmethod
+    def _checker_user_from_row(row):
+        """Build the checker's user dict from an iter_checker_users row."""
+        try:
+            products = json.loads(row["products"])
+            # Some older records hold the list as a JSON-encoded string
+            if isinstance(products, str):
+                products = json.loads(products)
+        except (TypeError, json.JSONDecodeError) as e:
+            logging.error(f"Invalid products for user {row['chat_id']}: {e}")
+            return None
+        if not isinstance(products, list) or not products:
+            return None
+        user = {
+            "chat_id": row["chat_id"],
+            "pincode": row["pincode"],
+            "products": products,
+            "notification_preference": row["notification_preference"],
+            "active": True,
+        }
+        if row["last_notified"] is not None:
+            user["last_notified"] = json.loads(row["last_notified"])
+        return user
+
+    async def get_user_statistics(self):
+        """Count users by activity, configuration and notification preference."""
+        try:
+            async with self._pool.acquire() as conn:
+                totals = await conn.fetchrow("""
+                    SELECT
+                        COUNT(*) AS total,
+                        COUNT(*) FILTER (
+                            WHERE data->'active' = 'true'::jsonb
+                        ) AS active,
+                        COUNT(*) FILTER (
+                            WHERE COALESCE(data->>'pincode', '') <> ''
+                            AND COALESCE(data->>'products', '[]')
+                                NOT IN ('[]', '""')
+                        ) AS configured
+                    FROM users
+                """)
+                rows = await conn.fetch("""
+                    SELECT
+                        COALESCE(
+                            data->>'notification_preference', 'until_stop'
+                        ) AS preference,
+                        COUNT(*) AS count
+                    FROM users
+                    GROUP BY 1
+                """)
+                return {
+                    "total": totals["total"],
+                    "active": totals["active"],
+                    "configured": totals["configured"],
+                    "preferences": {row["preference"]: row["count"] for row in rows},
+                }
+        except asyncpg.exceptions.PostgresError as e:
+            logging.error(f"Error getting user statistics: {e}")
+            return None
+
     async def get_all_users(self):
         """Retrieve all users for broadcasts or stats."""
         try:
@@ -381,6 +723,112 @@ class Database:
             )
             raise
 
+    async def record_state_changes(self, state_alias, product_status, unchanged=()):
+        """Record the state of every product for a state in one round trip.
+
+        product_status is a list of (product_name, status, inventory_quantity)
+        tuples. All rows are upserted by a single statement that also inserts
+        history rows for real transitions only. Products in unchanged (served
+        by a 304) are not rewritten when their stored row already matches.
+        Returns a dict mapping each product_name to its previous state (or
+        None if it was never seen).
+        """
+        latest = {}
+        for product_name, status, inventory_quantity in product_status:
+            latest[product_name] = (status, inventory_quantity)
+        if not latest:
+            return {}
+        names = list(latest)
+        statuses = [latest[name][0] for name in names]
+        quantities = [latest[name][1] for name in names]
+        now_iso = datetime.now().isoformat()  # Str for TEXT
+        try:
+            async with self._pool.acquire() as conn:
+                rows = await conn.fetch(
+                    """
+                    WITH incoming AS (
+                        SELECT * FROM unnest($2::text[], $3::text[], $4::int[])
+                            AS t(product_name, status, inventory_quantity)
+                    ),
+                    previous AS (
+                        SELECT s.product_name, s.status, s.inventory_quantity, s.timestamp
+                        FROM state_product_status s
+                        JOIN incoming i ON i.product_name = s.product_name
+                        WHERE s.state_alias = $1
+                    ),
+                    upserted AS (
+                        INSERT INTO state_product_status
+                        (state_alias, product_name, status, inventory_quantity, timestamp)
+                        SELECT $1, product_name, status, inventory_quantity, $5
+                        FROM incoming
+                        ON CONFLICT (state_alias, product_name)
+                        DO UPDATE SET
+                            status = EXCLUDED.status,
+                            inventory_quantity = EXCLUDED.inventory_quantity,
+                            timestamp = EXCLUDED.timestamp
+                        WHERE NOT (
+                            state_product_status.product_name = ANY($6::text[])
+                            AND state_product_status.status = EXCLUDED.status
+                            AND state_product_status.inventory_quantity
+                                IS NOT DISTINCT FROM EXCLUDED.inventory_quantity
+                        )
+                        RETURNING product_name
+                    ),
+                    history AS (
+                        INSERT INTO state_product_history
+                        (state_alias, product_name, status, inventory_quantity, timestamp)
+                        SELECT $1, i.product_name, i.status, i.inventory_quantity, $5
+                        FROM incoming i
+                        LEFT JOIN previous p ON p.product_name = i.product_name
+                        WHERE p.product_name IS NULL
+                            OR p.status <> i.status
+                            OR (
+                                p.status = 'In Stock'
+                                AND p.inventory_quantity = 0
+                                AND i.inventory_quantity > 0
+                            )
+                        RETURNING product_name
+                    )
+                    SELECT i.product_name, p.status, p.inventory_quantity, p.timestamp,
+                        h.product_name IS NOT NULL AS state_changed
+                    FROM incoming i
+                    LEFT JOIN previous p ON p.product_name = i.product_name
+                    LEFT JOIN history h ON h.product_name = i.product_name
+                """,
+                    state_alias,
+                    names,
+                    statuses,
+                    quantities,
+                    now_iso,
+                    list(unchanged),
+                )
+        except asyncpg.exceptions.PostgresError as e:
+            logging.error(f"Error recording state changes for {state_alias}: {e}")
+            raise
+
+        previous_states = {}
+        for row in rows:
+            product_name = row["product_name"]
+            previous_state = (
+                {
+                    "status": row["status"],
+                    "inventory_quantity": row["inventory_quantity"],
+                    "timestamp": row["timestamp"],
+                }
+                if row["status"] is not None
+                else None
+            )
+            previous_states[product_name] = previous_state
+            if row["state_changed"]:
+                status, inventory_quantity = latest[product_name]
+                logging.info(
+                    f"State transition: {state_alias} - {product_name} - {status} (quantity: {inventory_quantity}) [previous: {previous_state['status'] if previous_state else 'None'}]"
+                )
+        logging.debug(
+            f"Recorded {len(rows)} product states for {state_alias} in one statement"
+        )
+        return previous_states
+
     async def is_restock_event(
         self, state_alias, product_name, current_status, previous_state
     ):
@@ -538,6 +986,583 @@ class Database:
             logging.error(f"Timestamp parse error in get_last_sold_out_before: {e}")
             return None
 
+    async def get_api_sessions(self):
+        """Retrieve all persisted API sessions keyed by substore_id."""
+        try:
+            async with self._pool.acquire() as conn:
+                rows = await conn.fetch(
+                    """
+                    SELECT substore_id, pincode, tid, substore, cookies, created_at
+                    FROM api_sessions
+                """
+                )
+                sessions = {}
+                for row in rows:
+                    row_dict = dict(row)
+                    for key in ("substore", "cookies"):
+                        if isinstance(row_dict[key], str):
+                            row_dict[key] = json.loads(row_dict[key])
+                    row_dict["created_at"] = datetime.fromisoformat(
+                        row_dict["created_at"]
+                    )
+                    sessions[row_dict["substore_id"]] = row_dict
+                return sessions
+        except asyncpg.exceptions.PostgresError as e:
+            logging.error(f"Error getting API sessions: {e}")
+            return {}
+        except ValueError as e:
+            logging.error(f"Timestamp parse error in get_api_sessions: {e}")
+            return {}
+
+    async def save_api_session(
+        self, substore_id, pincode, tid, substore, cookies, created_at
+    ):
+        """Insert or replace the persisted API session for a substore."""
+        try:
+            async with self._pool.acquire() as conn:
+                await conn.execute(
+                    """
+                    INSERT INTO api_sessions
+                    (substore_id, pincode, tid, substore, cookies, created_at)
+                    VALUES ($1, $2, $3, $4::jsonb, $5::jsonb, $6)
+                    ON CONFLICT (substore_id)
+                    DO UPDATE SET
+                        pincode = EXCLUDED.pincode,
+                        tid = EXCLUDED.tid,
+                        substore = EXCLUDED.substore,
+                        cookies = EXCLUDED.cookies,
+                        created_at = EXCLUDED.created_at
+                """,
+                    substore_id,
+                    str(pincode),
+                    tid,
+                    json.dumps(substore),
+                    json.dumps(cookies),
+                    created_at.isoformat(),
+                )
+                logging.debug(f"Saved API session for substore {substore_id}")
+        except asyncpg.exceptions.PostgresError as e:
+            logging.error(f"Error saving API session for {substore_id}: {e}")
+
+    async def get_negative_pincodes(self):
+        """Return {pincode: reason} for pincodes not due for another lookup."""
+        try:
+            async with self._pool.acquire() as conn:
+                rows = await conn.fetch("""
+                    SELECT pincode, reason FROM pincode_negative_cache
+                    WHERE retry_at > now()
+                """)
+                return {row["pincode"]: row["reason"] for row in rows}
+        except asyncpg.exceptions.PostgresError as e:
+            logging.error(f"Error getting negative pincode cache: {e}")
+            return {}
+
+    async def get_pincode_failure(self, pincode):
+        """Return the negative cache entry for a pincode, or None."""
+        try:
+            async with self._pool.acquire() as conn:
+                row = await conn.fetchrow(
+                    """
+                    SELECT pincode, reason, failures, last_error, checked_at, retry_at
+                    FROM pincode_negative_cache WHERE pincode = $1
+                """,
+                    str(pincode),
+                )
+                return dict(row) if row else None
+        except asyncpg.exceptions.PostgresError as e:
+            logging.error(f"Error getting negative cache entry for {pincode}: {e}")
+            return None
+
+    async def record_pincode_failure(
+        self, pincode, reason, error, base_ttl, max_ttl, error_threshold=1
+    ):
+        """Count a failed lookup and push the next re-check back exponentially.
+
+        "no_substore" failures are cached from the first one. Other reasons
+        are only cached once error_threshold lookups in a row have failed.
+        The delay doubles with every further failure of the same reason,
+        capped at max_ttl; a change of reason restarts the count.
+        """
+        try:
+            async with self._pool.acquire() as conn:
+                async with conn.transaction():
+                    failures = await conn.fetchval(
+                        """
+                        INSERT INTO pincode_negative_cache AS n
+                        (pincode, reason, failures, last_error)
+                        VALUES ($1, $2, 1, $3)
+                        ON CONFLICT (pincode) DO UPDATE SET
+                            reason = EXCLUDED.reason,
+                            -- A new reason starts its own streak and backoff
+                            failures = CASE
+                                WHEN n.reason = EXCLUDED.reason
+                                    THEN n.failures + 1
+                                ELSE 1
+                            END,
+                            last_error = EXCLUDED.last_error,
+                            checked_at = now()
+                        RETURNING failures
+                    """,
+                        str(pincode),
+                        reason,
+                        error,
+                    )
+                    strikes = (
+                        failures
+                        if reason == "no_substore"
+                        else failures - error_threshold + 1
+                    )
+                    delay = (
+                        min(max_ttl, base_ttl * 2 ** (strikes - 1))
+                        if strikes > 0
+                        else 0
+                    )
+                    await conn.execute(
+                        """
+                        UPDATE pincode_negative_cache
+                        SET retry_at = now() + make_interval(secs => $2)
+                        WHERE pincode = $1
+                    """,
+                        str(pincode),
+                        float(delay),
+                    )
+                    if delay:
+                        logging.info(
+                            f"Cached pincode {pincode} as {reason} for {delay}s "
+                            f"after {failures} failures"
+                        )
+        except asyncpg.exceptions.PostgresError as e:
+            logging.error(f"Error recording failure for pincode {pincode}: {e}")
+
+    async def clear_pincode_failures(self, pincodes):
+        """Forget negative cache entries for pincodes that resolved."""
+        try:
+            async with self._pool.acquire() as conn:
+                await conn.execute(
+                    """
+                    DELETE FROM pincode_negative_cache
+                    WHERE pincode = ANY($1::text[])
+                """,
+                    [str(p) for p in pincodes],
+                )
+        except asyncpg.exceptions.PostgresError as e:
+            logging.error(f"Error clearing negative pincode cache: {e}")
+
+    async def get_product_response_cache(self):
+        """Retrieve cached product API responses keyed by (substore_id, cache_key)."""
+        try:
+            async with self._pool.acquire() as conn:
+                rows = await conn.fetch(
+                    """
+                    SELECT substore_id, cache_key, etag, last_modified, body, updated_at
+                    FROM product_response_cache
+                """
+                )
+                entries = {}
+                for row in rows:
+                    body = row["body"]
+                    if isinstance(body, str):
+                        body = json.loads(body)
+                    entries[(row["substore_id"], row["cache_key"])] = {
+                        "etag": row["etag"],
+                        "last_modified": row["last_modified"],
+                        "body": body,
+                        "updated_at": datetime.fromisoformat(row["updated_at"]),
+                    }
+                return entries
+        except asyncpg.exceptions.PostgresError as e:
+            logging.error(f"Error getting product response cache: {e}")
+            return {}
+        except ValueError as e:
+            logging.error(f"Timestamp parse error in get_product_response_cache: {e}")
+            return {}
+
+    async def save_product_response(
+        self, substore_id, cache_key, etag, last_modified, body, updated_at
+    ):
+        """Insert or replace a cached product API response."""
+        try:
+            async with self._pool.acquire() as conn:
+                await conn.execute(
+                    """
+                    INSERT INTO product_response_cache
+                    (substore_id, cache_key, etag, last_modified, body, updated_at)
+                    VALUES ($1, $2, $3, $4, $5::jsonb, $6)
+                    ON CONFLICT (substore_id, cache_key)
+                    DO UPDATE SET
+                        etag = EXCLUDED.etag,
+                        last_modified = EXCLUDED.last_modified,
+                        body = EXCLUDED.body,
+                        updated_at = EXCLUDED.updated_at
+                """,
+                    substore_id,
+                    cache_key,
+                    etag,
+                    last_modified,
+                    json.dumps(body),
+                    updated_at.isoformat(),
+                )
+        except asyncpg.exceptions.PostgresError as e:
+            logging.error(
+                f"Error saving product response cache for {substore_id}/{cache_key}: {e}"
+            )
+
+    async def merge_last_notified(self, updates, clear_staged=False):
+        """Merge buffered last_notified timestamps for many users at once.
+
+        updates maps chat_id to {product_name: iso timestamp}. The maps are
+        merged into each user's stored last_notified (normalizing the legacy
+        JSON-string form to an object) with one statement. With clear_staged,
+        the staged rows of these users (already part of updates) are deleted
+        in the same transaction.
+        Returns True on success.
+        """
+        chat_ids = []
+        maps = []
+        for chat_id, products in updates.items():
+            chat_ids.append(int(chat_id))
+            maps.append(json.dumps(products))
+        try:
+            async with self._pool.acquire() as conn:
+                async with conn.transaction():
+                    await conn.execute(
+                        """
+                        UPDATE users
+                        SET data = jsonb_set(
+                            data,
+                            '{last_notified}',
+                            CASE
+                                WHEN jsonb_typeof(data->'last_notified') = 'object'
+                                    THEN data->'last_notified'
+                                WHEN jsonb_typeof(data->'last_notified') = 'string'
+                                    AND jsonb_typeof(
+                                        try_jsonb(data->>'last_notified')
+                                    ) = 'object'
+                                    THEN try_jsonb(data->>'last_notified')
+                                ELSE '{}'::jsonb
+                            END || updates.last_notified::jsonb
+                        )
+                        FROM unnest($1::bigint[], $2::text[])
+                            AS updates(chat_id, last_notified)
+                        WHERE users.chat_id = updates.chat_id
+                    """,
+                        chat_ids,
+                        maps,
+                    )
+                    if clear_staged:
+                        await conn.execute(
+                            """
+                            DELETE FROM pending_last_notified
+                            WHERE chat_id = ANY($1::bigint[])
+                        """,
+                            chat_ids,
+                        )
+            return True
+        except asyncpg.exceptions.PostgresError as e:
+            logging.error(f"Error merging last_notified for {len(chat_ids)} users: {e}")
+            return False
+
+    async def stage_last_notified(self, updates):
+        """Keep last_notified updates that could not be merged for the next run.
+
+        updates has the merge_last_notified shape. Returns True on success.
+        """
+        chat_ids = []
+        products = []
+        times = []
+        for chat_id, notified in updates.items():
+            for product_name, notified_at in notified.items():
+                chat_ids.append(int(chat_id))
+                products.append(product_name)
+                times.append(notified_at)
+        try:
+            async with self._pool.acquire() as conn:
+                await conn.execute(
+                    """
+                    INSERT INTO pending_last_notified (chat_id, product, notified_at)
+                    SELECT * FROM unnest($1::bigint[], $2::text[], $3::text[])
+                    ON CONFLICT (chat_id, product)
+                    DO UPDATE SET notified_at = EXCLUDED.notified_at
+                """,
+                    chat_ids,
+                    products,
+                    times,
+                )
+            return True
+        except asyncpg.exceptions.PostgresError as e:
+            logging.error(f"Error staging last_notified for {len(updates)} users: {e}")
+            return False
+
+    async def get_staged_last_notified(self):
+        """Return staged updates as {chat_id: {product: iso timestamp}}.
+
+        Returns None if they could not be read.
+        """
+        try:
+            async with self._pool.acquire() as conn:
+                rows = await conn.fetch("""
+                    SELECT chat_id, product, notified_at FROM pending_last_notified
+                """)
+            staged = {}
+            for row in rows:
+                staged.setdefault(row["chat_id"], {})[row["product"]] = row[
+                    "notified_at"
+                ]
+            return staged
+        except asyncpg.exceptions.PostgresError as e:
+            logging.error(f"Error getting staged last_notified updates: {e}")
+            return None
+
+    async def enqueue_notifications(self, state_alias, snapshot_id, entries):
+        """Insert computed notifications into the outbox.
+
+        entries is a list of (chat_id, products_to_check, notify_products).
+        Rows whose idempotency key already exists, or whose user already has
+        an open notification for the state, are skipped. Returns the number
+        of rows inserted.
+        """
+        keys = []
+        chat_ids = []
+        products = []
+        notifications = []
+        for chat_id, products_to_check, notify_products in entries:
+            notified_names = sorted(name for name, _, _ in notify_products)
+            key_source = (
+                f"{chat_id}|{state_alias}|{','.join(notified_names)}|{snapshot_id}"
+            )
+            keys.append(hashlib.sha1(key_source.encode("utf-8")).hexdigest())
+            chat_ids.append(int(chat_id))
+            products.append(json.dumps(products_to_check))
+            notifications.append(json.dumps(notify_products))
+        try:
+            async with self._pool.acquire() as conn:
+                result = await conn.execute(
+                    """
+                    INSERT INTO notification_outbox (
+                        idempotency_key, chat_id, state_alias, snapshot_id,
+                        products_to_check, notify_products
+                    )
+                    SELECT entries.idempotency_key, entries.chat_id, $5, $6,
+                        entries.products_to_check::jsonb,
+                        entries.notify_products::jsonb
+                    FROM unnest($1::text[], $2::bigint[], $3::text[], $4::text[])
+                        AS entries(
+                            idempotency_key, chat_id,
+                            products_to_check, notify_products
+                        )
+                    ON CONFLICT DO NOTHING
+                """,
+                    keys,
+                    chat_ids,
+                    products,
+                    notifications,
+                    state_alias,
+                    snapshot_id,
+                )
+                return int(result.split()[-1])
+        except asyncpg.exceptions.PostgresError as e:
+            logging.error(f"Error enqueueing notifications for {state_alias}: {e}")
+            return 0
+
+    async def claim_notifications(self, limit, claim_timeout):
+        """Claim up to limit deliverable outbox rows for this worker.
+
+        Pending rows and rows whose claim is older than claim_timeout seconds
+        (left behind by a dead worker) are claimable. SKIP LOCKED lets
+        concurrent workers claim disjoint rows.
+        """
+        try:
+            async with self._pool.acquire() as conn:
+                rows = await conn.fetch(
+                    """
+                    UPDATE notification_outbox
+                    SET status = 'sending',
+                        claimed_at = now(),
+                        attempts = attempts + 1
+                    WHERE id IN (
+                        SELECT id FROM notification_outbox
+                        WHERE status = 'pending'
+                        OR (
+                            status = 'sending'
+                            AND claimed_at < now() - make_interval(secs => $2)
+                        )
+                        ORDER BY id
+                        LIMIT $1
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING id, chat_id, state_alias, products_to_check,
+                        notify_products, attempts
+                """,
+                    limit,
+                    float(claim_timeout),
+                )
+                claimed = []
+                for row in rows:
+                    row_dict = dict(row)
+                    for key in ("products_to_check", "notify_products"):
+                        if isinstance(row_dict[key], str):
+                            row_dict[key] = json.loads(row_dict[key])
+                    row_dict["notify_products"] = [
+                        tuple(product) for product in row_dict["notify_products"]
+                    ]
+                    claimed.append(row_dict)
+                return claimed
+        except asyncpg.exceptions.PostgresError as e:
+            logging.error(f"Error claiming outbox notifications: {e}")
+            return []
+
+    async def update_notification_status(self, outbox_id, status, error=None):
+        """Move an outbox row to delivered, failed, skipped or back to pending."""
+        try:
+            async with self._pool.acquire() as conn:
+                await conn.execute(
+                    """
+                    UPDATE notification_outbox
+                    SET status = $2,
+                        last_error = $3,
+                        finished_at = CASE WHEN $2 = 'pending' THEN NULL ELSE now() END
+                    WHERE id = $1
+                """,
+                    outbox_id,
+                    status,
+                    error,
+                )
+        except asyncpg.exceptions.PostgresError as e:
+            logging.error(f"Error updating outbox notification {outbox_id}: {e}")
+
+    async def prune_notification_outbox(self, max_age, retention_days):
+        """Expire undelivered rows older than max_age seconds and drop old rows."""
+        try:
+            async with self._pool.acquire() as conn:
+                async with conn.transaction():
+                    expired = await conn.execute(
+                        """
+                        UPDATE notification_outbox
+                        SET status = 'expired', finished_at = now()
+                        WHERE status IN ('pending', 'sending')
+                        AND created_at < now() - make_interval(secs => $1)
+                    """,
+                        float(max_age),
+                    )
+                    await conn.execute(
+                        """
+                        DELETE FROM notification_outbox
+                        WHERE status NOT IN ('pending', 'sending')
+                        AND created_at < now() - make_interval(days => $1)
+                    """,
+                        int(retention_days),
+                    )
+                    expired_count = int(expired.split()[-1])
+                    if expired_count:
+                        logging.warning(
+                            f"Expired {expired_count} undelivered outbox notifications"
+                        )
+        except asyncpg.exceptions.PostgresError as e:
+            logging.error(f"Error pruning notification outbox: {e}")
+
+    async def count_broadcast_targets(self, target_group):
+        """Count the users a broadcast to target_group would reach."""
+        try:
+            async with self._pool.acquire() as conn:
+                return await conn.fetchval(
+                    f"""
+                    SELECT COUNT(*) FROM users
+                    WHERE {BROADCAST_TARGET_FILTERS[target_group]}
+                """
+                )
+        except asyncpg.exceptions.PostgresError as e:
+            logging.error(f"Error counting {target_group} broadcast targets: {e}")
+            return 0
+
+    async def get_broadcast_chat_ids(self, target_group, after_chat_id, limit):
+        """Return the next chunk of recipient chat_ids after after_chat_id.
+
+        Keyset paging on the primary key keeps each chunk an index range scan
+        and lets an interrupted broadcast resume from its stored cursor.
+        """
+        try:
+            async with self._pool.acquire() as conn:
+                rows = await conn.fetch(
+                    f"""
+                    SELECT chat_id FROM users
+                    WHERE chat_id > $1
+                    AND {BROADCAST_TARGET_FILTERS[target_group]}
+                    ORDER BY chat_id
+                    LIMIT $2
+                """,
+                    after_chat_id,
+                    limit,
+                )
+                return [row["chat_id"] for row in rows]
+        except asyncpg.exceptions.PostgresError as e:
+            logging.error(f"Error fetching {target_group} broadcast targets: {e}")
+            raise
+
+    async def create_broadcast(self, admin_chat_id, target_group, message):
+        """Record a new running broadcast and return its id."""
+        now_iso = datetime.now().isoformat()
+        try:
+            async with self._pool.acquire() as conn:
+                return await conn.fetchval(
+                    """
+                    INSERT INTO broadcasts
+                    (admin_chat_id, target_group, message, created_at, updated_at)
+                    VALUES ($1, $2, $3, $4, $4)
+                    RETURNING id
+                """,
+                    int(admin_chat_id),
+                    target_group,
+                    message,
+                    now_iso,
+                )
+        except asyncpg.exceptions.PostgresError as e:
+            logging.error(f"Error creating broadcast: {e}")
+            return None
+
+    async def update_broadcast(
+        self, broadcast_id, last_chat_id, delivered, blocked, failed, status="running"
+    ):
+        """Persist a broadcast's cursor and counts."""
+        now_iso = datetime.now().isoformat()
+        try:
+            async with self._pool.acquire() as conn:
+                await conn.execute(
+                    """
+                    UPDATE broadcasts
+                    SET last_chat_id = $2, delivered = $3, blocked = $4,
+                        failed = $5, status = $6, updated_at = $7,
+                        finished_at = CASE WHEN $6 = 'running' THEN NULL ELSE $7 END
+                    WHERE id = $1
+                """,
+                    broadcast_id,
+                    last_chat_id,
+                    delivered,
+                    blocked,
+                    failed,
+                    status,
+                    now_iso,
+                )
+        except asyncpg.exceptions.PostgresError as e:
+            logging.error(f"Error updating broadcast {broadcast_id}: {e}")
+
+    async def get_running_broadcasts(self):
+        """Return broadcasts that were still running when the bot stopped."""
+        try:
+            async with self._pool.acquire() as conn:
+                rows = await conn.fetch(
+                    """
+                    SELECT id, admin_chat_id, target_group, message, last_chat_id,
+                        delivered, blocked, failed, created_at
+                    FROM broadcasts
+                    WHERE status = 'running'
+                    ORDER BY id
+                """
+                )
+                return [dict(row) for row in rows]
+        except asyncpg.exceptions.PostgresError as e:
+            logging.error(f"Error getting running broadcasts: {e}")
+            return []
+
     async def close(self):
         """Close the database connection pool."""
         try:
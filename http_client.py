@@ -0,0 +1,71 @@
+import logging
+import aiohttp
+from config import (
+    HTTP_POOL_LIMIT,
+    HTTP_POOL_LIMIT_PER_HOST,
+    HTTP_DNS_CACHE_TTL,
+    HTTP_KEEPALIVE_TIMEOUT,
+)
+
+logger = logging.getLogger(__name__)
+
+# Process-wide connection pool shared by every state check
+_connector = None
+_session = None
+
+
+def get_connector():
+    """Return the shared TCPConnector, creating it on first use."""
+    global _connector
+    if _connector is None or _connector.closed:
+        _connector = aiohttp.TCPConnector(
+            limit=HTTP_POOL_LIMIT,
+            limit_per_host=HTTP_POOL_LIMIT_PER_HOST,
+            ttl_dns_cache=HTTP_DNS_CACHE_TTL,
+            keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT,
+            enable_cleanup_closed=True,
+        )
+        logger.info("[HTTP] Created shared connection pool")
+    return _connector
+
+
+def get_http_session():
+    """Return the shared ClientSession for product API calls.
+
+    It keeps no cookies: each request carries its substore's cookies in an
+    explicit header, so sessions for different substores cannot leak into
+    each other.
+    """
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=get_connector(),
+            connector_owner=False,
+            cookie_jar=aiohttp.DummyCookieJar(),
+        )
+    return _session
+
+
+def create_isolated_session():
+    """Return a new ClientSession with its own cookie jar on the shared pool.
+
+    Used for session bootstraps, which need cookies to accumulate across
+    requests. The caller must close it; closing leaves the pool open.
+    """
+    return aiohttp.ClientSession(
+        connector=get_connector(),
+        connector_owner=False,
+        cookie_jar=aiohttp.CookieJar(unsafe=True),
+    )
+
+
+async def close_http_client():
+    """Close the shared session and connection pool."""
+    global _session, _connector
+    if _session is not None and not _session.closed:
+        await _session.close()
+    if _connector is not None and not _connector.closed:
+        await _connector.close()
+    _session = None
+    _connector = None
+    logger.info("[HTTP] Shared connection pool closed")
@@ -4,7 +4,6 @@ import base64
 import aiohttp
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.constants import ChatAction
-from substore_list import substore_info
 from telegram.ext import (
     Application,
     CommandHandler,
@@ -23,9 +22,16 @@ import sys
 
 # Local imports
 import common
-from common import get_product_info, create_product_list_markdown_links
+from common import (
+    get_product_info,
+    create_product_list_markdown_links,
+    is_any_subscription,
+)
 import config
 from database import Database
+from substore_mapping import get_pincode_index
+from broadcast import BroadcastWorker, start_broadcast, resume_broadcasts
+from send_scheduler import telegram_scheduler
 from config import DATABASE_URL, SENTRY_DSN, SENTRY_ENVIRONMENT
 from sentry_utils import init_sentry, create_task_catching
 import sentry_sdk
@@ -66,6 +72,7 @@ async def init_database():
     global db
     db = Database(DATABASE_URL)
     await db._init_db()
+    telegram_scheduler.attach(db)
 
 
 # Conversation states
@@ -286,7 +293,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             products = user.get("products", ["Any"])
             product_message = (
                 "All of the available Amul Protein products 🧀"
-                if len(products) == 1 and products[0].lower() == "any"
+                if is_any_subscription(products)
                 else "\n".join(
                     f"- {get_product_info(p, 'display_name') or p}" for p in products
                 )
@@ -336,6 +343,30 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(escaped_text, parse_mode="MarkdownV2")
 
 
+async def _warn_if_unserviceable(
+    chat_id: int, pincode: str, context: ContextTypes.DEFAULT_TYPE
+) -> None:
+    """Tell the user when the checker recently found no store for their pincode."""
+    failure = await db.get_pincode_failure(pincode)
+    if not failure or failure["reason"] != "no_substore":
+        return
+    try:
+        await context.bot.send_message(
+            chat_id=chat_id,
+            text=(
+                f"⚠️ Amul does not seem to deliver to PINCODE {pincode} right now. "
+                "It is saved and will be checked again periodically, but you may "
+                "not get notifications until it becomes serviceable."
+            ),
+        )
+    except TelegramError as e:
+        logger.debug(
+            "Failed to send unserviceable pincode warning to chat_id %s: %s",
+            chat_id,
+            str(e),
+        )
+
+
 async def _save_pincode(
     chat_id: int, pincode: str, context: ContextTypes.DEFAULT_TYPE
 ) -> bool:
@@ -396,6 +427,7 @@ async def set_pincode(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
             await update.message.reply_text(
                 f"✅ PINCODE set to {pincode} 📍. You will receive notifications for available products."
             )
+            await _warn_if_unserviceable(chat_id, pincode, context)
         else:
             await update.message.reply_text(
                 "⚠️ Failed to update your PINCODE. Please try again."
@@ -423,6 +455,7 @@ async def pincode_received(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         await update.message.reply_text(
             f"✅ Thank you! Your PINCODE has been set to {pincode} 📍."
         )
+        await _warn_if_unserviceable(chat_id, pincode, context)
     else:
         await update.message.reply_text(
             "⚠️ Failed to set your PINCODE. Please try again."
@@ -603,7 +636,7 @@ async def support_message_received(
     products = user.get("products", ["Any"]) if user else ["Any"]
     product_message = (
         "All available Amul Protein products"
-        if len(products) == 1 and products[0].lower() == "any"
+        if is_any_subscription(products)
         else "\n".join(
             f"- {get_product_info(p, 'display_name') or p}" for p in products
         )
@@ -1341,8 +1374,7 @@ async def set_products_callback(
                 current_tracked_products = user.get("products", ["Any"])
                 product_message = (
                     "All of the available Amul Protein products 🧀"
-                    if len(current_tracked_products) == 1
-                    and current_tracked_products[0].lower() == "any"
+                    if is_any_subscription(current_tracked_products)
                     else "\n".join(
                         f"- {get_product_info(p, 'display_name') or p}"
                         for p in current_tracked_products
@@ -1632,7 +1664,7 @@ async def my_settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
         products = ["Any"]
 
     # Format product names
-    if len(products) == 1 and products[0].lower() == "any":
+    if is_any_subscription(products):
         product_message = "All available Amul Protein products 🧀"
     else:
         # Use the new markdown link method from common.py
@@ -1743,7 +1775,7 @@ async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
         status_text += f"⚙️ *Notification Preference*: {preference_name}\n\n"
         status_text += f"🧀 *Tracked Products*:\n"
 
-        if len(products) == 1 and products[0].lower() == "any":
+        if is_any_subscription(products):
             status_text += "- All available Amul Protein products 🧀"
         else:
             for product in products:
@@ -1774,11 +1806,7 @@ async def unfollow_command(update: Update, context: ContextTypes.DEFAULT_TYPE) -
         return ConversationHandler.END  # End conversation if user not registered
 
     products_followed = user.get("products", [])
-    if (
-        not products_followed
-        or len(products_followed) == 1
-        and products_followed[0].lower() == "any"
-    ):
+    if not products_followed or is_any_subscription(products_followed):
         # Early exit if no specific products to unfollow
 
         await update.message.reply_text(
@@ -2100,20 +2128,10 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "Failed to delete transitional message for chat_id %s: %s", chat_id, str(e)
         )
 
-    # Get users from database
-    all_users = await db.get_all_users()
+    # Count recipients in the database; they are streamed when sending
+    target_count = await db.count_broadcast_targets(target_group)
 
-    # Filter users based on target group
-    if target_group == "all":
-        target_users = all_users
-    elif target_group == "active":
-        target_users = [user for user in all_users if user.get("active", False)]
-    elif target_group == "inactive":
-        target_users = [user for user in all_users if not user.get("active", False)]
-    else:
-        target_users = []
-
-    if not target_users:
+    if not target_count:
         await update.message.reply_text(
             f"⚠️ No {target_group} users found to broadcast to."
         )
@@ -2128,12 +2146,9 @@ async def broadcast(update: Update, context: ContextTypes.DEFAULT_TYPE):
     reply_markup = InlineKeyboardMarkup(keyboard)
     context.user_data["broadcast_message"] = message_to_broadcast
     context.user_data["broadcast_target"] = target_group
-    context.user_data["broadcast_target_users"] = (
-        target_users  # Store users for callback
-    )
 
     # Use the same approach as prev_main.py - escape the full message for display
-    base_text = f"📢 You are about to send the following message to {target_group} users:\n\n---\n{message_to_broadcast}\n---\n\nPlease confirm."
+    base_text = f"📢 You are about to send the following message to {target_count} {target_group} users:\n\n---\n{message_to_broadcast}\n---\n\nPlease confirm."
     escaped_full_text = escape_markdown(base_text)
 
     await update.message.reply_text(
@@ -2166,68 +2181,47 @@ async def broadcast_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
     if query.data == "broadcast_accept":
         message = context.user_data.get("broadcast_message")
         target_group = context.user_data.get("broadcast_target")
-        target_users = context.user_data.get(
-            "broadcast_target_users"
-        )  # Retrieve stored users
 
-        if not message or not target_users:
+        if not message or not target_group:
             await query.edit_message_text(
                 "⚠️ Error: Broadcast data not found. Please try again."
             )
             return
 
         # Escape the broadcast message using the same approach as prev_main.py
-        escaped_message = escape_markdown(message)
-
-        sent_count = 0
-        delay = 0.1  # Delay between sends to respect Telegram API limits
-
-        # NEW: Record start time here
-        start_time = time.time()
-        admin_chat_id = chat_id
-
-        for user in target_users:
-            try:
-                user_chat_id = int(user["chat_id"])
-                context.job_queue.run_once(
-                    send_broadcast_job,
-                    when=delay * sent_count,
-                    # FIXED: Pass only the escaped message (no prefix here)
-                    data={"chat_id": user_chat_id, "message": escaped_message},
-                )
-                sent_count += 1
-            except Exception as e:
-                logger.warning(
-                    f"Failed to queue broadcast for user {user.get('chat_id')}: {str(e)}"
-                )
+        text = f"📢 *Broadcast Message*:\n\n{escape_markdown(message)}"
+        broadcast_id = await db.create_broadcast(chat_id, target_group, text)
+        if broadcast_id is None:
+            await query.edit_message_text(
+                "⚠️ Error: Could not start the broadcast. Please try again."
+            )
+            return
 
-        # NEW: Queue completion job with a buffer after the last broadcast
-        completion_delay = delay * (sent_count + 1)  # Buffer to ensure all jobs finish
-        context.job_queue.run_once(
-            send_broadcast_completion,
-            when=completion_delay,
-            data={
-                "start_time": start_time,
-                "admin_chat_id": admin_chat_id,
-                "sent_count": sent_count,
-                "target_group": target_group,
-            },
+        start_broadcast(
+            BroadcastWorker(
+                context.bot,
+                db,
+                broadcast_id,
+                chat_id,
+                target_group,
+                text,
+                progress_message_id=query.message.message_id,
+            )
         )
 
         await query.edit_message_text(
-            f"✅ Broadcast queued for {sent_count} {target_group} users 📢. It will be sent in the background."
+            f"✅ Broadcast started for {target_group} users 📢. Progress will be shown here."
         )
         logger.info(
-            "Admin %s queued broadcast to %d %s users.",
+            "Admin %s started broadcast %s to %s users.",
             chat_id,
-            sent_count,
+            broadcast_id,
             target_group,
         )
 
         # Clear broadcast data
         context.user_data.pop("broadcast_message", None)
         context.user_data.pop("broadcast_target", None)
-        context.user_data.pop("broadcast_target_users", None)
 
     elif query.data == "broadcast_reject":
         await query.edit_message_text("❌ Broadcast canceled.")
@@ -2235,53 +2229,6 @@ async def broadcast_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
         # Clear broadcast data
         context.user_data.pop("broadcast_message", None)
         context.user_data.pop("broadcast_target", None)
-        context.user_data.pop("broadcast_target_users", None)
-
-
-async def send_broadcast_job(context: ContextTypes.DEFAULT_TYPE):
-    """Job queue function to send a single broadcast message asynchronously."""
-    job_data = context.job.data
-    chat_id = job_data["chat_id"]
-    message = job_data["message"]
-    try:
-        # FIXED: Add the prefix only here (once) to avoid duplication
-        await context.bot.send_message(
-            chat_id=chat_id,
-            text=f"📢 *Broadcast Message*:\n\n{message}",
-            parse_mode="MarkdownV2",
-        )
-        logger.info("Broadcast sent to chat_id %s", chat_id)
-    except Exception as e:
-        logger.error("Failed to send broadcast to chat_id %s: %s", chat_id, str(e))
-
-
-async def send_broadcast_completion(context: ContextTypes.DEFAULT_TYPE):
-    """Job queue function to send a completion message after all broadcasts."""
-    job_data = context.job.data
-    end_time = time.time()
-    start_time = job_data["start_time"]
-    duration = end_time - start_time
-    admin_chat_id = job_data["admin_chat_id"]
-    sent_count = job_data["sent_count"]
-    target_group = job_data["target_group"]
-
-    # Construct the raw message
-    raw_message = f"✅ Broadcast completed successfully! It took {duration:.2f} seconds for {sent_count} {target_group} users."
-
-    # Escape for MarkdownV2 to fix the '!' issue
-    escaped_message = escape_markdown(raw_message)
-
-    try:
-        await context.bot.send_message(
-            chat_id=admin_chat_id, text=escaped_message, parse_mode="MarkdownV2"
-        )
-        logger.info("Broadcast completion message sent to admin %s", admin_chat_id)
-    except Exception as e:
-        logger.error(
-            "Failed to send broadcast completion message to admin %s: %s",
-            admin_chat_id,
-            str(e),
-        )
 
 
 async def bot_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -2320,20 +2267,10 @@ async def bot_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         set(user.get("pincode") for user in all_users if user.get("pincode"))
     )
 
-    # Top 3 States (from prev_main.py, using substore_info)
-    pincode_to_state = {}
-    for state_data in substore_info:
-        state = state_data["name"]
-        if state_data["pincodes"]:
-            pincodes = state_data["pincodes"]
-            # Handle both string and list cases
-            if isinstance(pincodes, str):
-                pincodes = pincodes.split(",")
-            for pincode in pincodes:
-                pincode_to_state[str(pincode).strip()] = state
-
+    # Top 3 States (from prev_main.py, using the shared pincode index)
+    pincode_index = get_pincode_index()
     user_states = [
-        pincode_to_state.get(user.get("pincode", "").strip(), "Unknown")
+        pincode_index.state_name_for(user.get("pincode", "")) or "Unknown"
         for user in all_users
     ]
     known_user_states = [state for state in user_states if state != "Unknown"]
@@ -2423,6 +2360,7 @@ async def run_polling(app: Application):
     global db
     db = Database(config.DATABASE_URL)
     await db._init_db()
+    telegram_scheduler.attach(db)
 
     for chat_data in app.chat_data.values():
         for key in [
@@ -2445,6 +2383,7 @@ async def run_polling(app: Application):
     logger.info("Polling started")
 
     app.job_queue.run_repeating(cleanup_support_requests, interval=3600)
+    await resume_broadcasts(app.bot, db)
 
     try:
         await asyncio.Event().wait()
@@ -0,0 +1,153 @@
+import asyncio
+import logging
+import time
+
+from config import (
+    LAST_NOTIFIED_FLUSH_BATCH_SIZE,
+    LAST_NOTIFIED_FLUSH_INTERVAL,
+    LAST_NOTIFIED_FLUSH_RETRIES,
+)
+
+logger = logging.getLogger(__name__)
+
+
+class LastNotifiedBuffer:
+    """Buffers last_notified updates and writes them in bulk.
+
+    Successful sends add {product: timestamp} entries per user. Once
+    batch_size users are pending, or the oldest pending update is
+    flush_interval seconds old, they are written with one
+    Database.merge_last_notified call; a background task flushes on the
+    interval even when no new updates arrive. A failed write is retried
+    with backoff and then kept in the buffer for the next flush. Updates
+    still unwritten at close are staged in the pending_last_notified table
+    and merged when the next run loads, before its users are read.
+    """
+
+    def __init__(
+        self,
+        batch_size=LAST_NOTIFIED_FLUSH_BATCH_SIZE,
+        max_retries=LAST_NOTIFIED_FLUSH_RETRIES,
+        flush_interval=LAST_NOTIFIED_FLUSH_INTERVAL,
+    ):
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.flush_interval = flush_interval
+        self._db = None
+        self._pending = {}  # chat_id -> {product_name: iso timestamp}
+        self._pending_since = None  # monotonic time of the oldest pending update
+        self._has_staged = False  # pending includes rows staged by a previous run
+        self._lock = asyncio.Lock()
+        self._flush_task = None
+
+    async def load(self, db):
+        """Attach the database and merge updates staged by a previous run.
+
+        Call this before reading users, so their last_notified already
+        includes the staged updates.
+        """
+        self._db = db
+        self._flush_task = asyncio.create_task(self._flush_periodically())
+        staged = await db.get_staged_last_notified()
+        if staged is None:
+            # Staged rows could not be read; leave them for the next run
+            return
+        if not staged:
+            return
+        for chat_id, products in staged.items():
+            self._merge(chat_id, products)
+        self._has_staged = True
+        if await self.flush():
+            logger.info(f"[TRACKING] Merged {len(staged)} staged last_notified updates")
+        else:
+            logger.warning(
+                f"[TRACKING] Could not merge {len(staged)} staged last_notified "
+                "updates before the check; those users may be notified again"
+            )
+
+    async def _flush_periodically(self):
+        while True:
+            # Poll often enough that no update outlives flush_interval by much
+            await asyncio.sleep(min(1, self.flush_interval))
+            if (
+                self._pending_since is not None
+                and time.monotonic() - self._pending_since >= self.flush_interval
+            ):
+                try:
+                    await self.flush()
+                except Exception as e:
+                    logger.error(f"[TRACKING] Periodic last_notified flush failed: {e}")
+
+    def _merge(self, chat_id, products):
+        if self._pending_since is None:
+            self._pending_since = time.monotonic()
+        self._pending.setdefault(chat_id, {}).update(products)
+
+    async def add(self, chat_id, products):
+        """Buffer {product_name: iso timestamp} for a user and flush when due."""
+        self._merge(int(chat_id), products)
+        if (
+            len(self._pending) >= self.batch_size
+            or time.monotonic() - self._pending_since >= self.flush_interval
+        ):
+            await self.flush()
+
+    async def flush(self):
+        """Write all pending updates. Returns False if the write failed."""
+        async with self._lock:
+            if not self._pending:
+                return True
+            if self._db is None:
+                return False
+            batch, self._pending = self._pending, {}
+            pending_since, self._pending_since = self._pending_since, None
+            clear_staged = self._has_staged
+            for attempt in range(self.max_retries):
+                if await self._db.merge_last_notified(batch, clear_staged):
+                    logger.info(
+                        f"[TRACKING] Flushed last_notified for {len(batch)} users"
+                    )
+                    # Staged updates were merged into the first batch
+                    self._has_staged = False
+                    return True
+                if attempt < self.max_retries - 1:
+                    await asyncio.sleep(2**attempt)
+            # Keep the failed batch; anything added meanwhile is newer and wins
+            newer, self._pending = self._pending, batch
+            self._pending_since = pending_since
+            for chat_id, products in newer.items():
+                self._merge(chat_id, products)
+            logger.error(
+                f"[TRACKING] Failed to flush last_notified for {len(batch)} users, "
+                "keeping them for the next flush"
+            )
+            return False
+
+    async def close(self):
+        """Flush what is left and stage anything unwritten in the database."""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
+        if self._pending and self._db is not None:
+            if await self._db.stage_last_notified(self._pending):
+                logger.warning(
+                    f"[TRACKING] Staged {len(self._pending)} last_notified updates "
+                    "for the next run"
+                )
+            else:
+                logger.error(
+                    f"[TRACKING] Lost last_notified updates for {len(self._pending)} "
+                    "users; they may be notified again"
+                )
+        self._pending = {}
+        self._pending_since = None
+        self._has_staged = False
+        self._db = None
+
+
+last_notified_buffer = LastNotifiedBuffer()
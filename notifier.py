@@ -2,14 +2,77 @@ import sys
 import os
 
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
-import asyncio
 from utils import mask
-from common import get_product_info, create_product_url
+from common import get_product_info, create_product_url, is_any_subscription
+from send_scheduler import telegram_scheduler, SENT, BLOCKED, REJECTED
 import logging
 
 logger = logging.getLogger(__name__)
 
 
+def render_notification_message(pincode, products, check_all_products):
+    """Build the Markdown body for (name, quantity) pairs of in-stock products."""
+    lines = [f"Available Amul Protein Products for PINCODE {pincode}:\n"]
+    for name, quantity in products:
+        short_name = get_product_info(name, "display_name") or name
+        product_link = create_product_url(name)
+        if product_link:
+            lines.append(
+                f"- {short_name} \n(Quantity Left: {quantity}) | [Buy Now]({product_link})"
+            )
+        else:
+            lines.append(f"- {short_name} \n(Quantity Left: {quantity})")
+    if not check_all_products:
+        lines.append("\nUse /unfollow to stop notifications for specific products.")
+    return "\n".join(lines) + ("\n" if check_all_products else "")
+
+
+class MessageRenderCache:
+    """Rendered notification bodies shared by users within one run.
+
+    Users with the same pincode, the same in-stock products and quantities
+    and the same "Any" flag get byte-identical text, so each distinct body
+    is rendered once. Call clear() at the start of a run so quantities from
+    an earlier run are never reused.
+    """
+
+    def __init__(self):
+        self._messages = {}  # (pincode, ((name, quantity), ...), any-flag) -> text
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, pincode, products, check_all_products):
+        key = (str(pincode), tuple(products), check_all_products)
+        message = self._messages.get(key)
+        if message is not None:
+            self.hits += 1
+            return message
+        self.misses += 1
+        message = render_notification_message(*key)
+        self._messages[key] = message
+        return message
+
+    def clear(self):
+        self._messages.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "messages": len(self._messages),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+        }
+
+    def log_stats(self):
+        logger.info(f"[RENDER CACHE] {self.stats()}")
+
+
+message_render_cache = MessageRenderCache()
+
+
 async def send_telegram_notification_for_user(
     app, chat_id, pincode, products_to_check, notify_products, max_retries=3
 ):
@@ -30,9 +93,7 @@ async def send_telegram_notification_for_user(
         logger.info(f"No products to notify for chat_id {chat_id}")
         return True  # Return True as this is a valid case
 
-    check_all_products = (
-        len(products_to_check) == 1 and products_to_check[0].strip().lower() == "any"
-    )
+    check_all_products = is_any_subscription(products_to_check)
 
     in_stock_products = [
         (name, status, quantity)
@@ -43,81 +104,31 @@ async def send_telegram_notification_for_user(
         logger.info(f"All products Sold Out for chat_id {chat_id}, PINCODE {pincode}")
         return True  # Return True as this is a valid case
 
-    # Simplified message construction
-    message = f"Available Amul Protein Products for PINCODE {pincode}:\n\n"
-    relevant_products = (
-        in_stock_products
-        if check_all_products
-        else [
-            (name, status, quantity)
-            for name, status, quantity in in_stock_products
-            if name in products_to_check
-        ]
+    wanted_products = set(products_to_check)
+    relevant_products = [
+        (name, quantity)
+        for name, _, quantity in in_stock_products
+        if check_all_products or name in wanted_products
+    ]
+    message = message_render_cache.render(
+        pincode, relevant_products, check_all_products
     )
-    for name, _, quantity in relevant_products:
-        short_name = get_product_info(name, "display_name") or name
-        product_link = create_product_url(name)
-        if product_link:
-            message += f"- {short_name} \n(Quantity Left: {quantity}) | [Buy Now]({product_link})\n"
-        else:
-            message += f"- {short_name} \n(Quantity Left: {quantity})\n"
-
-    if not check_all_products:
-        message += "\nUse /unfollow to stop notifications for specific products."
 
     logger.info(
         f"Sending notification to chat_id {chat_id}: {len(relevant_products)} products"
     )
 
-    # Add retry logic with timeouts
-    for attempt in range(max_retries):
-        try:
-            async with asyncio.timeout(10):  # 10 second timeout per attempt
-                await app.bot.send_message(
-                    chat_id=chat_id,
-                    text=message,
-                    parse_mode="Markdown",
-                    disable_web_page_preview=True,
-                )
-                logger.info(f"Successfully sent notification to chat_id {chat_id}")
-                return True  # Successfully sent
-        except asyncio.TimeoutError:
-            if attempt < max_retries - 1:
-                logger.warning(
-                    f"Attempt {attempt + 1} timed out for chat_id {chat_id}, retrying..."
-                )
-                await asyncio.sleep(1)  # Small delay between retries
-            else:
-                logger.error(
-                    f"Timeout sending notification to chat_id {chat_id} after {max_retries} attempts"
-                )
-                return False
-        except ValueError as e:
-            logger.error(
-                f"Invalid chat_id format for {chat_id}: {str(e)}. Skipping notification."
-            )
-            return False
-        except Exception as e:
-            error_msg = str(e)
-            if any(
-                x in error_msg.lower()
-                for x in [
-                    "chat not found",
-                    "bot was blocked",
-                    "forbidden",
-                    "bad request",
-                ]
-            ):
-                logger.error(f"Permanent error for chat_id {chat_id}: {error_msg}")
-                return None  # Permanent error, don't retry
-
-            logger.error(
-                f"Temporary error sending notification to chat_id {chat_id}: {error_msg}"
-            )
-            if attempt < max_retries - 1:
-                logger.info(
-                    f"Will retry notification for chat_id {chat_id} ({attempt + 2}/{max_retries})"
-                )
-                await asyncio.sleep(2)  # Longer delay for unexpected errors
-                continue
-            return False  # Temporary error after all retries failed
+    status = await telegram_scheduler.send_message(
+        app.bot,
+        chat_id,
+        message,
+        max_retries=max_retries,
+        parse_mode="Markdown",
+        disable_web_page_preview=True,
+    )
+    if status == SENT:
+        logger.info(f"Successfully sent notification to chat_id {chat_id}")
+        return True
+    if status in (BLOCKED, REJECTED):
+        return None  # Permanent error, don't retry
+    return False  # Temporary error after all retries failed
@@ -1,28 +1,60 @@
 from api_client import (
-    get_tid_and_substore,
     fetch_product_data_for_alias_async,
+    fetch_products_for_aliases_async,
     product_api_rate_limiter,
+    product_api_controller,
+    log_rate_limiter_stats,
+    PincodeLookupError,
+    PincodeNotServiceableError,
 )
-from substore_mapping import load_substore_mapping, save_substore_mapping
+from http_client import get_http_session, close_http_client
+from response_cache import product_response_cache
+from notification_tracking import last_notified_buffer
+from session_cache import session_cache
+from substore_mapping import PincodeIndex, discovery_journal, get_pincode_index
 from cache import substore_cache, substore_pincode_map, pincode_cache
 from utils import is_product_in_stock, mask
-from notifier import send_telegram_notification_for_user
+from notifier import send_telegram_notification_for_user, message_render_cache
+from send_scheduler import telegram_scheduler
+from sentry_utils import create_task_catching
 import asyncio
 import sys
 import os
+import time
 from config import (
     TELEGRAM_BOT_TOKEN,
     SEMAPHORE_LIMIT,
     USE_SUBSTORE_CACHE,
     FALLBACK_TO_PINCODE_CACHE,
     NOTIFICATION_CONCURRENCY_LIMIT,
+    PRODUCT_API_BATCH_FETCH,
+    ADAPTIVE_CONCURRENCY_ENABLED,
+    NOTIFICATION_PIPELINE_ENABLED,
+    PIPELINE_STATE_QUEUE_SIZE,
+    PIPELINE_NOTIFICATION_QUEUE_SIZE,
+    NOTIFICATION_OUTBOX_ENABLED,
+    OUTBOX_CLAIM_BATCH_SIZE,
+    OUTBOX_CLAIM_TIMEOUT,
+    OUTBOX_MAX_ATTEMPTS,
+    OUTBOX_MAX_AGE,
+    OUTBOX_POLL_INTERVAL,
+    OUTBOX_RETENTION_DAYS,
+    PINCODE_RESOLVE_CONCURRENCY,
+    PINCODE_PREFIX_INFERENCE,
+    PINCODE_NEGATIVE_TTL,
+    PINCODE_NEGATIVE_MAX_TTL,
+    PINCODE_ERROR_THRESHOLD,
 )
 import logging
 from datetime import datetime
 from telegram.ext import Application
-from common import PRODUCT_ALIAS_MAP, get_product_info
-import cloudscraper
-import aiohttp
+from common import (
+    PRODUCT_ALIAS_MAP,
+    PRODUCT_BITS,
+    is_any_subscription,
+    products_to_mask,
+    status_mask,
+)
 import json
 import sentry_sdk
 
@@ -80,10 +112,7 @@ async def should_notify_user(user, product_name, status, state_alias, db, is_res
 
     if preference == "once_and_stop":
         # For all products tracking ("Any"), handle all available products
-        check_all_products = (
-            len(user.get("products", [])) == 1
-            and user.get("products", [""])[0].lower() == "any"
-        )
+        check_all_products = is_any_subscription(user.get("products", [""]))
 
         # For new tracking (empty last_notified):
         # 1. For specific products: notify if product is in stock
@@ -162,8 +191,12 @@ async def should_notify_user(user, product_name, status, state_alias, db, is_res
 
 
 # In product_checker.py, update_user_notification_tracking
-async def update_user_notification_tracking(user, product_name, db):
-    """Update last_notified timestamp for a product using partial update."""
+async def update_user_notification_tracking(user, product_names):
+    """Record last_notified timestamps for products and buffer the write.
+
+    The in-memory user is updated immediately; the database write is batched
+    with other users' updates by last_notified_buffer.
+    """
     if not isinstance(user, dict):
         logger.error(
             f"Invalid user data type for chat_id {user.get('chat_id', 'unknown')}: {type(user)}"
@@ -200,18 +233,18 @@ async def update_user_notification_tracking(user, product_name, db):
         # Update the tracking based on preference
         if preference in ["once_and_stop", "once_per_restock"]:
             # Update in-memory structure first so callers see immediate change
-            last_notified[product_name] = now_iso
+            notified = {product_name: now_iso for product_name in product_names}
+            last_notified.update(notified)
             user["last_notified"] = last_notified
-            path = ["last_notified"]
-            await db.update_user_partial(chat_id, path, json.dumps(last_notified))
+            await last_notified_buffer.add(chat_id, notified)
             logger.debug(
-                f"Updated {preference} notification tracking for user {chat_id} - {product_name}. last_notified now: {list(last_notified.keys())}"
+                f"Updated {preference} notification tracking for user {chat_id} - {product_names}. last_notified now: {list(last_notified.keys())}"
             )
             return True
 
     except Exception as e:
         logger.error(
-            f"Error updating notification tracking for user {chat_id}, product {product_name}: {str(e)}"
+            f"Error updating notification tracking for user {chat_id}, products {product_names}: {str(e)}"
         )
         return False
 
@@ -219,7 +252,7 @@ async def update_user_notification_tracking(user, product_name, db):
 
 
 async def get_products_availability_api_only_async(
-    pincode, max_concurrent_products=SEMAPHORE_LIMIT
+    pincode, max_concurrent_products=SEMAPHORE_LIMIT, substore_id=None
 ):
     logger.info(f"Fetching availability for pincode: {pincode}")
     # Add a breadcrumb so Sentry shows which pincode was being processed
@@ -229,70 +262,150 @@ async def get_products_availability_api_only_async(
         level="info",
     )
     try:
-        sync_session = cloudscraper.create_scraper()
-        tid, substore, substore_id, cookies = get_tid_and_substore(
-            sync_session, pincode
+        tid, substore, substore_id, cookies = await session_cache.get_session(
+            pincode, substore_id
         )
-        async with aiohttp.ClientSession(cookies=cookies) as session:
+        product_response_cache.begin(substore_id)
+        session = get_http_session()
+        if ADAPTIVE_CONCURRENCY_ENABLED:
+            semaphore = product_api_controller.limiter(substore_id)
+        else:
             semaphore = asyncio.Semaphore(max_concurrent_products)
-            tasks = [
-                (
-                    product_name,
-                    get_product_info(product_name, "slug"),
-                    fetch_product_data_for_alias_async(
-                        session,
+        batch_results = {}
+        refresh_failed = False
+        if PRODUCT_API_BATCH_FETCH:
+            batch_results = await fetch_products_for_aliases_async(
+                session,
+                tid,
+                substore_id,
+                list(PRODUCT_ALIAS_MAP.values()),
+                semaphore,
+                cookies=cookies,
+            )
+            if batch_results is None:
+                logger.warning(
+                    "Session expired during batch fetch. Refreshing session..."
+                )
+                batch_results = {}
+                try:
+                    (
                         tid,
+                        substore,
                         substore_id,
-                        get_product_info(product_name, "slug"),
-                        semaphore,
-                        cookies=cookies,
-                    ),
-                )
-                for product_name in PRODUCT_ALIAS_MAP.keys()
-            ]
-            product_status = []
-            results = await asyncio.gather(
-                *[task for _, _, task in tasks], return_exceptions=True
-            )
-            for (product_name, alias, _), data in zip(tasks, results):
-                if isinstance(data, Exception):
-                    logger.error(f"Error fetching data for {product_name}: {data}")
-                    continue
-                if data is None:
-                    logger.warning(
-                        f"Session expired for {product_name}. Refreshing session..."
+                        cookies,
+                    ) = await session_cache.refresh_after_unauthorized(
+                        pincode, substore_id, tid
                     )
-                    sync_session = cloudscraper.create_scraper()
-                    tid, substore, substore_id, cookies = get_tid_and_substore(
-                        sync_session, pincode
-                    )
-                    async with aiohttp.ClientSession(cookies=cookies) as new_session:
-                        data = await fetch_product_data_for_alias_async(
-                            new_session,
+                except Exception as e:
+                    # Per-alias requests would be rejected with the same tid
+                    logger.error(f"Session refresh failed for pincode {pincode}: {e}")
+                    refresh_failed = True
+                else:
+                    batch_results = (
+                        await fetch_products_for_aliases_async(
+                            session,
                             tid,
                             substore_id,
-                            alias,
+                            list(PRODUCT_ALIAS_MAP.values()),
                             semaphore,
                             cookies=cookies,
                         )
-                if data:
-                    in_stock, quantity = is_product_in_stock(data[0], substore_id)
-                    # Tag the product and substore for richer Sentry context
-                    sentry_sdk.set_tag("substore_id", str(substore_id))
-                    sentry_sdk.set_tag("product_name", product_name)
-                    product_status.append(
-                        (product_name, "In Stock" if in_stock else "Sold Out", quantity)
+                        or {}
                     )
-                else:
-                    product_status.append((product_name, "Sold Out", 0))
-            return product_status, substore_id, substore
+        pending = [
+            (product_name, alias)
+            for product_name, alias in PRODUCT_ALIAS_MAP.items()
+            if alias not in batch_results and not refresh_failed
+        ]
+        if PRODUCT_API_BATCH_FETCH and pending:
+            logger.info(
+                f"Falling back to per-alias requests for {len(pending)} aliases missing from batch response"
+            )
+        fetched = dict(batch_results)
+        results = await asyncio.gather(
+            *[
+                fetch_product_data_for_alias_async(
+                    session, tid, substore_id, alias, semaphore, cookies=cookies
+                )
+                for _, alias in pending
+            ],
+            return_exceptions=True,
+        )
+        expired = []
+        for (product_name, alias), data in zip(pending, results):
+            if isinstance(data, Exception):
+                logger.error(f"Error fetching data for {product_name}: {data}")
+                continue
+            if data is None:
+                expired.append((product_name, alias))
+                continue
+            fetched[alias] = data
+        if expired:
+            # One refresh per substore, then retry all rejected aliases at once
+            logger.warning(
+                f"Session expired for {len(expired)} products. Refreshing session..."
+            )
+            try:
+                (
+                    tid,
+                    substore,
+                    substore_id,
+                    cookies,
+                ) = await session_cache.refresh_after_unauthorized(
+                    pincode, substore_id, tid
+                )
+            except Exception as e:
+                # Keep the products already fetched with the old session
+                logger.error(
+                    f"Session refresh failed for pincode {pincode}, skipping "
+                    f"{len(expired)} products: {e}"
+                )
+                expired = []
+            results = await asyncio.gather(
+                *[
+                    fetch_product_data_for_alias_async(
+                        session, tid, substore_id, alias, semaphore, cookies=cookies
+                    )
+                    for _, alias in expired
+                ],
+                return_exceptions=True,
+            )
+            for (product_name, alias), data in zip(expired, results):
+                if isinstance(data, Exception):
+                    logger.error(f"Error fetching data for {product_name}: {data}")
+                    continue
+                fetched[alias] = data
+        product_status = []
+        for product_name, alias in PRODUCT_ALIAS_MAP.items():
+            if alias not in fetched:
+                continue
+            data = fetched[alias]
+            if data:
+                in_stock, quantity = is_product_in_stock(data[0], substore_id)
+                # Tag the product and substore for richer Sentry context
+                sentry_sdk.set_tag("substore_id", str(substore_id))
+                sentry_sdk.set_tag("product_name", product_name)
+                product_status.append(
+                    (product_name, "In Stock" if in_stock else "Sold Out", quantity)
+                )
+            else:
+                product_status.append((product_name, "Sold Out", 0))
+        unchanged_aliases = product_response_cache.unchanged_aliases(substore_id)
+        unchanged_products = {
+            product_name
+            for product_name, alias in PRODUCT_ALIAS_MAP.items()
+            if alias in unchanged_aliases
+        }
+        return product_status, substore_id, substore, unchanged_products
     except Exception as e:
         logger.error(f"Error in get_products_availability_api_only_async: {e}")
         sentry_sdk.capture_exception(e)
-        return [], None, None
+        return [], None, None, set()
 
 
-async def check_product_availability_for_state(state_alias, sample_pincode, db):
+async def check_product_availability_for_state(
+    state_alias, sample_pincode, db, substore_id=None
+):
     logger.info(f"Checking state {state_alias} with pincode: {sample_pincode}")
     sentry_sdk.add_breadcrumb(
         category="state_check",
@@ -304,22 +417,38 @@ async def check_product_availability_for_state(state_alias, sample_pincode, db):
             cached_status = substore_cache.get(state_alias)
             if cached_status:
                 logger.info(f"Cache hit for state {state_alias}")
-                for product_name, status, inventory_quantity in cached_status:
-                    await db.record_state_change(
-                        state_alias, product_name, status, inventory_quantity
-                    )
+                await db.record_state_changes(state_alias, cached_status)
                 return cached_status, {}
         (
             product_status,
             substore_id,
             substore,
-        ) = await get_products_availability_api_only_async(sample_pincode)
+            unchanged_products,
+        ) = await get_products_availability_api_only_async(
+            sample_pincode, substore_id=substore_id
+        )
         restock_info = {}
+        if unchanged_products:
+            logger.info(
+                f"{len(unchanged_products)} products unchanged for state {state_alias}"
+            )
         if product_status:
+            # Unchanged products are only rewritten when their stored row is
+            # missing or stale, e.g. after a failed earlier write
+            previous_states = await db.record_state_changes(
+                state_alias, product_status, unchanged_products
+            )
             for product_name, status, inventory_quantity in product_status:
-                previous_state = await db.record_state_change(
-                    state_alias, product_name, status, inventory_quantity
-                )
+                previous_state = previous_states.get(product_name)
+                if (
+                    product_name in unchanged_products
+                    and previous_state
+                    and previous_state["status"] == status
+                    and previous_state["inventory_quantity"] == inventory_quantity
+                ):
+                    # 304 Not Modified and the stored state already matched
+                    restock_info[product_name] = False
+                    continue
                 is_restock = await db.is_restock_event(
                     state_alias, product_name, status, previous_state
                 )
@@ -374,398 +503,816 @@ async def validate_user_state(user, db):
         return False
 
 
-async def should_deactivate_user(chat_id, app):
+def build_product_masks(users):
+    """Map int chat_id to the user's product subscription bitmask."""
+    product_masks = {}
+    for user in users:
+        if not isinstance(user, dict):
+            continue
+        try:
+            chat_id = int(user.get("chat_id"))
+        except (TypeError, ValueError):
+            continue
+        product_masks[chat_id] = products_to_mask(user.get("products", []))
+    return product_masks
+
+
+async def evaluate_user_notifications(
+    user,
+    state_alias,
+    product_status,
+    restock_info,
+    db,
+    in_stock_mask=None,
+    product_masks=None,
+):
+    """Return (chat_id, products_to_check, notify_products) for one user, or None.
+
+    in_stock_mask and product_masks let callers compute the state's in-stock
+    bitmask and the users' subscription bitmasks once instead of per user.
     """
-    Determine if a user should be deactivated based on their chat state.
+    if not isinstance(user, dict):
+        logger.error(f"Invalid user data type for state {state_alias}")
+        return None
+
+    chat_id = user.get("chat_id")
+    if not chat_id:
+        logger.warning(f"User in state {state_alias} has no chat_id")
+        return None
+
+    try:
+        chat_id = int(chat_id)  # Convert to int early to catch invalid format
+    except ValueError:
+        logger.error(f"Invalid chat_id format in state {state_alias}: {chat_id}")
+        return None
+
+    products_to_check = user.get("products", [])
+    if not chat_id or not products_to_check:
+        return None
+    product_mask = (product_masks or {}).get(chat_id)
+    if product_mask is None:
+        product_mask = products_to_mask(products_to_check)
+    if in_stock_mask is None:
+        in_stock_mask = status_mask(product_status)
+    wanted_mask = product_mask & in_stock_mask
+    if not wanted_mask:
+        return None
+    notify_products = [
+        (name, status, qty)
+        for name, status, qty in product_status
+        if PRODUCT_BITS.get(name, 0) & wanted_mask
+        and await should_notify_user(
+            user,
+            name,
+            status,
+            state_alias,
+            db,
+            restock_info.get(name, False),
+        )
+    ]
+    if not notify_products:
+        return None
+    return chat_id, products_to_check, notify_products
+
+
+async def send_user_notification(
+    app,
+    db,
+    chat_id,
+    user,
+    products_to_check,
+    notify_products,
+    products_notified,
+    notification_semaphore,
+):
+    """Send one user's notification under their lock and update tracking.
+
+    Returns True on success, None on permanent failure (the user is
+    deactivated) and False on temporary failure.
     """
     try:
-        async with asyncio.timeout(5):
-            # Try to get chat member info
-            chat = await app.bot.get_chat(chat_id)
-            if not chat:
-                logger.info(f"Chat {chat_id} not found")
-                return True
-            return False
+        async with user_locks[chat_id]:
+            if not await validate_user_state(user, db):
+                logger.info(
+                    f"User {chat_id} is no longer active or has invalid configuration"
+                )
+                return None  # Don't retry for invalid users
+            async with notification_semaphore:
+                logger.info(f"Starting notification process for user {chat_id}")
+                # Add Sentry context for this send
+                try:
+                    with sentry_sdk.push_scope() as scope:
+                        scope.set_tag("chat_id", str(chat_id))
+                        # try to get state alias from user or notify_products
+                        state_alias = (
+                            user.get("state_alias") if isinstance(user, dict) else None
+                        )
+                        if not state_alias and notify_products:
+                            # notify_products contains tuples (name, status, qty)
+                            # products_to_check contains user's product filter
+                            scope.set_tag("state_alias", str(state_alias))
+                        scope.set_extra(
+                            "products_to_notify",
+                            [p for p, _, _ in notify_products],
+                        )
+                        sentry_sdk.add_breadcrumb(
+                            category="notification",
+                            message=f"sending_notification chat_id={chat_id} products={[p for p, _, _ in notify_products]}",
+                            level="info",
+                        )
+                        result = await send_telegram_notification_for_user(
+                            app,
+                            chat_id,
+                            user.get("pincode"),
+                            products_to_check,
+                            notify_products,
+                        )
+                except Exception as e:
+                    # Ensure exceptions during Sentry push_scope don't break notification flow
+                    logger.error(f"Error adding Sentry scope for user {chat_id}: {e}")
+                    result = await send_telegram_notification_for_user(
+                        app,
+                        chat_id,
+                        user.get("pincode"),
+                        products_to_check,
+                        notify_products,
+                    )
+                if result is True:  # Success
+                    try:
+                        await update_user_notification_tracking(
+                            user, products_notified
+                        )
+                        logger.info(
+                            f"Successfully notified user {chat_id} for {len(products_notified)} products"
+                        )
+                        return True
+                    except Exception as e:
+                        logger.error(
+                            f"Error updating notification tracking for user {chat_id}: {str(e)}"
+                        )
+                        return True  # Still return True as notification succeeded
+                elif result is None:  # Permanent error
+                    logger.warning(
+                        f"Permanent error for user {chat_id}, deactivating..."
+                    )
+                    await db.update_user_partial(chat_id, ["active"], False)
+                    return None  # Don't retry
+                else:  # Temporary error (False)
+                    logger.warning(f"Temporary error for user {chat_id}, may retry")
+                    return False
+    except asyncio.CancelledError:
+        logger.warning(f"Notification task cancelled for user {chat_id}")
+        raise
     except Exception as e:
-        error_msg = str(e).lower()
-        # Deactivate if bot was blocked or chat not found
-        if (
-            "blocked" in error_msg
-            or "not found" in error_msg
-            or "forbidden" in error_msg
-        ):
-            return True
-        # For other errors, don't deactivate
-        logger.error(f"Error checking chat state for {chat_id}: {str(e)}")
+        logger.error(
+            f"Unexpected error in notification task for user {chat_id}: {str(e)}"
+        )
         return False
+    return True
 
 
-async def check_products_for_users(db):
-    logger.info("Starting product check for all users")
-    try:
-        await db.cleanup_state_history()
-        users = await db.get_all_users()
-        total_users = len(users)
-        if not users:
-            logger.warning("No users found in database")
-            return
+def log_notification_summary(results, total):
+    """Log success/permanent/temporary counts for a list of send results."""
+    success_count = 0
+    permanent_error_count = 0
+    temp_error_count = 0
+    for result in results:
+        if isinstance(result, Exception):
+            temp_error_count += 1
+        elif result is True:
+            success_count += 1
+        elif result is None:
+            permanent_error_count += 1
+        else:
+            temp_error_count += 1
 
-        # Log user statistics
-        active_users = sum(1 for user in users if user.get("active", False))
-        configured_users = sum(
-            1 for user in users if user.get("pincode") and user.get("products")
-        )
-        preference_stats = {"until_stop": 0, "once_and_stop": 0, "once_per_restock": 0}
-        for user in users:
-            pref = user.get("notification_preference", "until_stop")
-            preference_stats[pref] = preference_stats.get(pref, 0) + 1
-
-        logger.info(f"User Statistics:")
-        logger.info(f"Total Users: {total_users}")
-        logger.info(f"Active Users: {active_users}")
-        logger.info(f"Configured Users: {configured_users}")
-        logger.info(f"Notification Preferences: {preference_stats}")
-        state_groups = {}
-        pincode_to_state = {}
-        unmapped_users = []
-        substore_info = load_substore_mapping() if USE_SUBSTORE_CACHE else []
+    logger.info(
+        f"Completed notifications: {success_count} successful, "
+        f"{permanent_error_count} permanent failures, "
+        f"{temp_error_count} temporary failures out of {total} total"
+    )
+
+
+def index_users_by_chat_id(state_groups):
+    """Map int chat_id to its user dict across all state groups."""
+    users_by_chat_id = {}
+    for users in state_groups.values():
         for user in users:
             if not isinstance(user, dict):
-                logger.error(f"Invalid user data type: {type(user)}")
-                continue
-            pincode = user.get("pincode")
-            if not pincode:
-                logger.warning(f"User {user.get('chat_id')} has no pincode")
                 continue
-            state_alias = pincode_to_state.get(pincode)
-            if state_alias:
-                state_groups[state_alias].append(user)
+            try:
+                users_by_chat_id[int(user.get("chat_id"))] = user
+            except (TypeError, ValueError):
                 continue
-            for sub in substore_info:
-                if str(pincode) in sub.get("pincodes", []):
-                    state_alias = sub["alias"]
-                    break
-            if not state_alias and FALLBACK_TO_PINCODE_CACHE:
-                state_alias = pincode_cache.get(pincode)
-            if not state_alias:
-                try:
-                    sync_session = cloudscraper.create_scraper()
-                    _, substore, substore_id, _ = get_tid_and_substore(
-                        sync_session, pincode
-                    )
-                    state_alias = (
-                        substore.get("alias", f"unknown-{pincode}")
-                        if isinstance(substore, dict)
-                        else str(substore)
-                    )
-                    # Use substore_id if available, fallback to _id from substore object
-                    new_id = substore_id or (
-                        substore.get("_id", "") if isinstance(substore, dict) else ""
-                    )
+    return users_by_chat_id
 
-                    # Check if an entry with this alias already exists
-                    existing_sub = next(
-                        (sub for sub in substore_info if sub["alias"] == state_alias),
-                        None,
-                    )
 
-                    if existing_sub:
-                        need_update = False
-                        # Add the new pincode if not already there
-                        if str(pincode) not in existing_sub["pincodes"]:
-                            existing_sub["pincodes"].append(str(pincode))
-                            need_update = True
-                            logger.info(
-                                f"Added pincode {pincode} to existing substore {state_alias}"
-                            )
-
-                        # Update _id if it's empty and we have a new one
-                        if not existing_sub["_id"] and new_id:
-                            existing_sub["_id"] = new_id
-                            need_update = True
-                            logger.info(
-                                f"Updated empty _id for substore {state_alias} to {new_id}"
-                            )
+async def build_user_notifications(
+    state_groups, state_results, db, product_masks=None
+):
+    """Evaluate every user against their state's result.
 
-                        if need_update:
-                            save_substore_mapping(substore_info)
-                    else:
-                        # Create new entry only if alias doesn't exist
-                        new_sub = {
-                            "alias": state_alias,
-                            "_id": new_id,
-                            "name": substore.get("name", state_alias.title())
-                            if isinstance(substore, dict)
-                            else state_alias.title(),
-                            "pincodes": [str(pincode)],
-                        }
-                        substore_info.append(new_sub)
-                        logger.info(
-                            f"Created new substore entry for {state_alias} with pincode {pincode}"
-                        )
-                        save_substore_mapping(substore_info)
+    state_results maps state alias to (product_status, restock_info). Returns
+    chat_id -> (user, products_to_check, notify_products), merged across
+    states. Users are looked up through a chat_id index and merged through
+    sets, so the work grows linearly with the number of users.
+    """
+    users_by_chat_id = index_users_by_chat_id(state_groups)
+    # chat_id -> (products list, products set, notify dict used as an ordered set)
+    merged = {}
+    for state_alias, (product_status, restock_info) in state_results.items():
+        if not product_status:
+            logger.warning(f"No product status for state {state_alias}")
+            continue
+        in_stock_mask = status_mask(product_status)
+        for user in state_groups.get(state_alias, []):
+            evaluated = await evaluate_user_notifications(
+                user,
+                state_alias,
+                product_status,
+                restock_info,
+                db,
+                in_stock_mask=in_stock_mask,
+                product_masks=product_masks,
+            )
+            if not evaluated:
+                continue
+            chat_id, products_to_check, notify_products = evaluated
+            if chat_id in merged:
+                products, seen_products, notify = merged[chat_id]
+                for name in products_to_check:
+                    if name not in seen_products:
+                        seen_products.add(name)
+                        products.append(name)
+                notify.update(dict.fromkeys(notify_products))
+                logger.debug(f"Merged notifications for user {chat_id}")
+            else:
+                merged[chat_id] = (
+                    list(products_to_check),
+                    set(products_to_check),
+                    dict.fromkeys(notify_products),
+                )
+                if chat_id not in user_locks:
+                    user_locks[chat_id] = asyncio.Lock()
+            logger.info(
+                f"Prepared notifications for user {chat_id}: {[name for name, _, _ in notify_products]}"
+            )
 
-                    pincode_to_state[pincode] = state_alias
-                except Exception as e:
-                    logger.error(f"Error mapping pincode {pincode}: {e}")
-                    unmapped_users.append(user)
-                    continue
-            state_groups.setdefault(state_alias, []).append(user)
+    return {
+        chat_id: (users_by_chat_id.get(chat_id), products, list(notify))
+        for chat_id, (products, _, notify) in merged.items()
+    }
 
-        states_to_check = list(state_groups.keys())
-        logger.info(f"Checking {len(states_to_check)} states")
 
-        app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
-        await app.initialize()
-        try:
-            state_tasks = [
-                check_product_availability_for_state(
-                    state, state_groups[state][0]["pincode"], db
-                )
-                for state in states_to_check
-            ]
-            results = await asyncio.gather(*state_tasks, return_exceptions=True)
+async def run_gathered_notifications(
+    app, db, state_groups, states_to_check, substore_ids, product_masks=None
+):
+    """Check every state, then build and send all notifications."""
+    state_tasks = [
+        check_product_availability_for_state(
+            state,
+            state_groups[state][0]["pincode"],
+            db,
+            substore_id=substore_ids.get(state),
+        )
+        for state in states_to_check
+    ]
+    results = await asyncio.gather(*state_tasks, return_exceptions=True)
+
+    state_results = {}
+    for idx, state_alias in enumerate(states_to_check):
+        if isinstance(results[idx], Exception):
+            logger.error(f"Error processing state {state_alias}: {results[idx]}")
+            continue
+        state_results[state_alias] = results[idx]
+    user_notifications = await build_user_notifications(
+        state_groups, state_results, db, product_masks
+    )
 
-            notification_semaphore = asyncio.Semaphore(NOTIFICATION_CONCURRENCY_LIMIT)
-            notification_tasks = []
-            user_notifications = {}  # Track notifications per user: chat_id -> (products, state)
+    notification_semaphore = asyncio.Semaphore(NOTIFICATION_CONCURRENCY_LIMIT)
+    notification_tasks = []
+    for chat_id, (
+        user,
+        products_to_check,
+        notify_products,
+    ) in user_notifications.items():
+        products_notified = [name for name, _, _ in notify_products]
+        logger.info(
+            f"Creating notification task for user {chat_id} with {len(products_notified)} products"
+        )
+        # Create and add the task with name for better tracking
+        task = asyncio.create_task(
+            send_user_notification(
+                app,
+                db,
+                chat_id,
+                user,
+                products_to_check,
+                notify_products,
+                products_notified,
+                notification_semaphore,
+            ),
+            name=f"notify_{chat_id}",
+        )
+        notification_tasks.append(task)
 
-            # First pass: collect all notifications per user across all states
-            for idx, state_alias in enumerate(states_to_check):
-                if isinstance(results[idx], Exception):
+    # Wait for all notification tasks to complete and handle any errors
+    if notification_tasks:
+        logger.info(
+            f"Waiting for {len(notification_tasks)} notification tasks to complete..."
+        )
+        try:
+            results = await asyncio.gather(*notification_tasks, return_exceptions=True)
+            for task, result in zip(notification_tasks, results):
+                if isinstance(result, Exception):
                     logger.error(
-                        f"Error processing state {state_alias}: {results[idx]}"
+                        f"Notification task {task.get_name()} failed with error: {str(result)}"
                     )
+            log_notification_summary(results, len(notification_tasks))
+        except Exception as e:
+            logger.error(f"Error while gathering notification tasks: {str(e)}")
+    else:
+        logger.info("No notifications to send")
+    logger.info("All notification tasks completed")
+
+
+async def run_notification_pipeline(
+    app, db, state_groups, states_to_check, substore_ids, product_masks=None
+):
+    """Check states and send notifications as a streaming pipeline.
+
+    Each state's result goes to the evaluation stage as soon as that state
+    finishes, and prepared notifications go to a pool of sender workers.
+    Both hand-offs use bounded queues, so a slow stage applies backpressure
+    to the one before it. Users in fast states therefore do not wait for the
+    slowest state. A user belongs to exactly one state group, so there is
+    nothing to merge across states.
+    """
+    state_queue = asyncio.Queue(maxsize=PIPELINE_STATE_QUEUE_SIZE)
+    notification_queue = asyncio.Queue(maxsize=PIPELINE_NOTIFICATION_QUEUE_SIZE)
+    notification_semaphore = asyncio.Semaphore(NOTIFICATION_CONCURRENCY_LIMIT)
+    worker_count = max(1, NOTIFICATION_CONCURRENCY_LIMIT)
+    send_results = []
+
+    async def check_state(state_alias):
+        try:
+            result = await check_product_availability_for_state(
+                state_alias,
+                state_groups[state_alias][0]["pincode"],
+                db,
+                substore_id=substore_ids.get(state_alias),
+            )
+        except Exception as e:
+            result = e
+        await state_queue.put((state_alias, result))
+
+    async def enqueue_state(state_alias, product_status, restock_info):
+        in_stock_mask = status_mask(product_status)
+        for user in state_groups[state_alias]:
+            evaluated = await evaluate_user_notifications(
+                user,
+                state_alias,
+                product_status,
+                restock_info,
+                db,
+                in_stock_mask=in_stock_mask,
+                product_masks=product_masks,
+            )
+            if not evaluated:
+                continue
+            chat_id, products_to_check, notify_products = evaluated
+            if chat_id not in user_locks:
+                user_locks[chat_id] = asyncio.Lock()
+            logger.info(
+                f"Prepared notifications for user {chat_id}: {[name for name, _, _ in notify_products]}"
+            )
+            await notification_queue.put(
+                (chat_id, user, products_to_check, notify_products)
+            )
+
+    async def evaluate_states():
+        try:
+            for _ in range(len(states_to_check)):
+                state_alias, result = await state_queue.get()
+                if isinstance(result, Exception):
+                    logger.error(f"Error processing state {state_alias}: {result}")
                     continue
-                product_status, restock_info = results[idx]
+                product_status, restock_info = result
                 if not product_status:
                     logger.warning(f"No product status for state {state_alias}")
                     continue
-                for user in state_groups[state_alias]:
-                    if not isinstance(user, dict):
-                        logger.error(f"Invalid user data type for state {state_alias}")
-                        continue
-
-                    chat_id = user.get("chat_id")
-                    if not chat_id:
-                        logger.warning(f"User in state {state_alias} has no chat_id")
-                        continue
+                try:
+                    await enqueue_state(state_alias, product_status, restock_info)
+                except Exception as e:
+                    # Keep draining state_queue so no state check blocks on put
+                    logger.error(
+                        f"Error preparing notifications for state {state_alias}: {e}"
+                    )
+        finally:
+            for _ in range(worker_count):
+                await notification_queue.put(None)
+
+    async def send_worker():
+        while True:
+            job = await notification_queue.get()
+            if job is None:
+                return
+            chat_id, user, products_to_check, notify_products = job
+            try:
+                result = await send_user_notification(
+                    app,
+                    db,
+                    chat_id,
+                    user,
+                    products_to_check,
+                    notify_products,
+                    [name for name, _, _ in notify_products],
+                    notification_semaphore,
+                )
+            except Exception as e:
+                logger.error(f"Notification for user {chat_id} failed with error: {e}")
+                result = e
+            send_results.append(result)
+
+    await asyncio.gather(
+        *(check_state(state_alias) for state_alias in states_to_check),
+        evaluate_states(),
+        *(send_worker() for _ in range(worker_count)),
+    )
+    if send_results:
+        log_notification_summary(send_results, len(send_results))
+    else:
+        logger.info("No notifications to send")
+    logger.info("All notification tasks completed")
 
-                    try:
-                        chat_id = int(
-                            chat_id
-                        )  # Convert to int early to catch invalid format
-                    except ValueError:
-                        logger.error(
-                            f"Invalid chat_id format in state {state_alias}: {chat_id}"
-                        )
-                        continue
 
-                    products_to_check = user.get("products", [])
-                    if not chat_id or not products_to_check:
-                        continue
-                    check_all_products = (
-                        len(products_to_check) == 1
-                        and products_to_check[0].strip().lower() == "any"
-                    )
-                    notify_products = [
-                        (name, status, qty)
-                        for name, status, qty in product_status
-                        if (check_all_products or name in products_to_check)
-                        and await should_notify_user(
-                            user,
-                            name,
-                            status,
-                            state_alias,
-                            db,
-                            restock_info.get(name, False),
-                        )
-                    ]
-                    if notify_products:
-                        products_notified = [name for name, _, _ in notify_products]
-                        if chat_id in user_notifications:
-                            # Merge with existing notifications
-                            existing_products = user_notifications[chat_id][0]
-                            existing_notify = user_notifications[chat_id][1]
-                            merged_products = list(
-                                set(existing_products + products_to_check)
-                            )
-                            merged_notify = [
-                                (n, s, q)
-                                for n, s, q in notify_products + existing_notify
-                                if (n, s, q) not in existing_notify
-                            ]
-                            user_notifications[chat_id] = (
-                                merged_products,
-                                merged_notify,
-                            )
-                            logger.debug(f"Merged notifications for user {chat_id}")
-                        else:
-                            user_notifications[chat_id] = (
-                                products_to_check,
-                                notify_products,
-                            )
-                            if chat_id not in user_locks:
-                                user_locks[chat_id] = asyncio.Lock()
-                        logger.info(
-                            f"Prepared notifications for user {chat_id}: {products_notified}"
-                        )
+async def run_outbox_notifications(
+    app, db, state_groups, states_to_check, substore_ids, product_masks=None
+):
+    """Queue notifications in the database outbox and deliver them from it.
+
+    Detection inserts each state's notifications into notification_outbox
+    as soon as the state finishes. A pool of sender workers claims rows
+    with FOR UPDATE SKIP LOCKED and marks them delivered, so sending scales
+    separately from detection. Rows left undelivered by an earlier run that
+    died are claimed again here, which resumes that run's sends, as long as
+    they are younger than OUTBOX_MAX_AGE; older leftovers are expired.
+    """
+    snapshot_id = datetime.now().isoformat()
+    users_by_chat_id = index_users_by_chat_id(state_groups)
+    notification_semaphore = asyncio.Semaphore(NOTIFICATION_CONCURRENCY_LIMIT)
+    detection_done = asyncio.Event()
+    rows_queued = asyncio.Event()
+    send_results = []
+
+    await db.prune_notification_outbox(OUTBOX_MAX_AGE, OUTBOX_RETENTION_DAYS)
+
+    async def detect_state(state_alias):
+        product_status, restock_info = await check_product_availability_for_state(
+            state_alias,
+            state_groups[state_alias][0]["pincode"],
+            db,
+            substore_id=substore_ids.get(state_alias),
+        )
+        if not product_status:
+            logger.warning(f"No product status for state {state_alias}")
+            return
+        in_stock_mask = status_mask(product_status)
+        entries = []
+        for user in state_groups[state_alias]:
+            evaluated = await evaluate_user_notifications(
+                user,
+                state_alias,
+                product_status,
+                restock_info,
+                db,
+                in_stock_mask=in_stock_mask,
+                product_masks=product_masks,
+            )
+            if evaluated:
+                entries.append(evaluated)
+        if entries:
+            inserted = await db.enqueue_notifications(
+                state_alias, snapshot_id, entries
+            )
+            logger.info(
+                f"Queued {inserted} of {len(entries)} notifications for state {state_alias}"
+            )
+            rows_queued.set()
 
-            # Define the notification sending function outside the loop
-            async def locked_send(
-                chat_id, user, products_to_check, notify_products, products_notified
-            ):
+    async def detect():
+        try:
+            results = await asyncio.gather(
+                *(detect_state(state_alias) for state_alias in states_to_check),
+                return_exceptions=True,
+            )
+            for state_alias, result in zip(states_to_check, results):
+                if isinstance(result, Exception):
+                    logger.error(f"Error processing state {state_alias}: {result}")
+        finally:
+            detection_done.set()
+            rows_queued.set()
+
+    async def deliver(row):
+        chat_id = row["chat_id"]
+        user = users_by_chat_id.get(chat_id)
+        if user is None:
+            await db.update_notification_status(
+                row["id"], "skipped", "user is no longer active"
+            )
+            return None
+        if chat_id not in user_locks:
+            user_locks[chat_id] = asyncio.Lock()
+        try:
+            result = await send_user_notification(
+                app,
+                db,
+                chat_id,
+                user,
+                row["products_to_check"],
+                row["notify_products"],
+                [name for name, _, _ in row["notify_products"]],
+                notification_semaphore,
+            )
+        except Exception as e:
+            logger.error(f"Notification for user {chat_id} failed with error: {e}")
+            result = e
+        if result is True:
+            await db.update_notification_status(row["id"], "delivered")
+        elif result is None:
+            await db.update_notification_status(
+                row["id"], "failed", "permanent send error"
+            )
+        elif row["attempts"] >= OUTBOX_MAX_ATTEMPTS:
+            await db.update_notification_status(
+                row["id"], "failed", f"gave up after {row['attempts']} attempts"
+            )
+        else:
+            await db.update_notification_status(
+                row["id"], "pending", "temporary send error"
+            )
+        return result
+
+    async def send_worker():
+        while True:
+            # Read the flag before claiming so rows queued by the last state
+            # are never missed
+            finished = detection_done.is_set()
+            # Clear before claiming so a set() during the claim is not lost
+            rows_queued.clear()
+            rows = await db.claim_notifications(
+                OUTBOX_CLAIM_BATCH_SIZE, OUTBOX_CLAIM_TIMEOUT
+            )
+            if not rows:
+                if finished:
+                    return
                 try:
-                    async with user_locks[chat_id]:
-                        if not await validate_user_state(user, db):
-                            logger.info(
-                                f"User {chat_id} is no longer active or has invalid configuration"
-                            )
-                            return None  # Don't retry for invalid users
-                        async with notification_semaphore:
-                            logger.info(
-                                f"Starting notification process for user {chat_id}"
-                            )
-                            # Add Sentry context for this send
-                            try:
-                                with sentry_sdk.push_scope() as scope:
-                                    scope.set_tag("chat_id", str(chat_id))
-                                    # try to get state alias from user or notify_products
-                                    state_alias = user.get("state_alias") if isinstance(user, dict) else None
-                                    if not state_alias and notify_products:
-                                        # notify_products contains tuples (name, status, qty)
-                                        # products_to_check contains user's product filter
-                                        scope.set_tag("state_alias", str(state_alias))
-                                    scope.set_extra(
-                                        "products_to_notify",
-                                        [p for p, _, _ in notify_products],
-                                    )
-                                    sentry_sdk.add_breadcrumb(
-                                        category="notification",
-                                        message=f"sending_notification chat_id={chat_id} products={[p for p,_,_ in notify_products]}",
-                                        level="info",
-                                    )
-                                    result = await send_telegram_notification_for_user(
-                                        app,
-                                        chat_id,
-                                        user.get("pincode"),
-                                        products_to_check,
-                                        notify_products,
-                                    )
-                            except Exception as e:
-                                # Ensure exceptions during Sentry push_scope don't break notification flow
-                                logger.error(f"Error adding Sentry scope for user {chat_id}: {e}")
-                                result = await send_telegram_notification_for_user(
-                                    app,
-                                    chat_id,
-                                    user.get("pincode"),
-                                    products_to_check,
-                                    notify_products,
-                                )
-                            if result is True:  # Success
-                                try:
-                                    for product_name in products_notified:
-                                        await update_user_notification_tracking(
-                                            user, product_name, db
-                                        )
-                                    logger.info(
-                                        f"Successfully notified user {chat_id} for {len(products_notified)} products"
-                                    )
-                                    return True
-                                except Exception as e:
-                                    logger.error(
-                                        f"Error updating notification tracking for user {chat_id}: {str(e)}"
-                                    )
-                                    return True  # Still return True as notification succeeded
-                            elif result is None:  # Permanent error
-                                logger.warning(
-                                    f"Permanent error for user {chat_id}, deactivating..."
-                                )
-                                await db.update_user_partial(chat_id, ["active"], False)
-                                return None  # Don't retry
-                            else:  # Temporary error (False)
-                                logger.warning(
-                                    f"Temporary error for user {chat_id}, may retry"
-                                )
-                except asyncio.CancelledError:
-                    logger.warning(f"Notification task cancelled for user {chat_id}")
-                    raise
-                except Exception as e:
-                    logger.error(
-                        f"Unexpected error in notification task for user {chat_id}: {str(e)}"
+                    await asyncio.wait_for(rows_queued.wait(), OUTBOX_POLL_INTERVAL)
+                except TimeoutError:
+                    pass
+                continue
+            for row in rows:
+                send_results.append(await deliver(row))
+
+    await asyncio.gather(
+        detect(),
+        *(send_worker() for _ in range(max(1, NOTIFICATION_CONCURRENCY_LIMIT))),
+    )
+    if send_results:
+        log_notification_summary(send_results, len(send_results))
+    else:
+        logger.info("No notifications to send")
+    logger.info("All notification tasks completed")
+
+
+async def resolve_unmapped_pincodes(
+    pincodes,
+    pincode_index,
+    concurrency=PINCODE_RESOLVE_CONCURRENCY,
+    record=True,
+    db=None,
+):
+    """Map distinct unknown pincodes to substores concurrently.
+
+    Each pincode is bootstrapped once, at most `concurrency` at a time; the
+    bootstrap requests themselves go through the per-endpoint rate limiters.
+    Returns {pincode: state_alias}, with None for pincodes that failed, so
+    every user sharing a failed pincode is skipped without another lookup.
+    With a db, failures go to the negative pincode cache and successes clear
+    it.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def resolve(pincode):
+        async with semaphore:
+            try:
+                _, substore, substore_id, _ = await session_cache.refresh(pincode)
+            except Exception as e:
+                logger.error(f"Error mapping pincode {pincode}: {e}")
+                # Only failures caused by the pincode itself are cached;
+                # challenges, rate limits and timeouts say nothing about it
+                if isinstance(e, PincodeNotServiceableError):
+                    reason = "no_substore"
+                elif isinstance(e, PincodeLookupError):
+                    reason = "error"
+                else:
+                    reason = None
+                if db is not None and reason:
+                    await db.record_pincode_failure(
+                        pincode,
+                        reason,
+                        str(e),
+                        PINCODE_NEGATIVE_TTL,
+                        PINCODE_NEGATIVE_MAX_TTL,
+                        PINCODE_ERROR_THRESHOLD,
                     )
-                    return False
-                return True
+                return pincode, None
+        state_alias = (
+            substore.get("alias", f"unknown-{pincode}")
+            if isinstance(substore, dict)
+            else str(substore)
+        )
+        # Use substore_id if available, fallback to _id from substore object
+        new_id = substore_id or (
+            substore.get("_id", "") if isinstance(substore, dict) else ""
+        )
+        name = substore.get("name") if isinstance(substore, dict) else None
+        if pincode_index.add(pincode, state_alias, new_id, name) and record:
+            await discovery_journal.record(
+                pincode_index, pincode, state_alias, new_id, name
+            )
+        return pincode, state_alias
+
+    start_time = time.time()
+    results = dict(await asyncio.gather(*(resolve(p) for p in pincodes)))
+    failed = sum(1 for alias in results.values() if alias is None)
+    if db is not None and failed < len(results):
+        await db.clear_pincode_failures(
+            [pincode for pincode, alias in results.items() if alias]
+        )
+    logger.info(
+        f"Resolved {len(results) - failed}/{len(results)} unmapped pincodes "
+        f"in {time.time() - start_time:.2f}s"
+    )
+    return results
 
-            # After collecting all notifications, create tasks
-            for chat_id, (
-                products_to_check,
-                notify_products,
-            ) in user_notifications.items():
-                products_notified = [name for name, _, _ in notify_products]
-                logger.info(
-                    f"Creating notification task for user {chat_id} with {len(products_notified)} products"
+
+async def confirm_inferred_pincodes(inferred, pincode_index, record=True, db=None):
+    """Look up pincodes whose state was inferred from their prefix.
+
+    Runs alongside the product check. Confirmed pincodes are added to the
+    index like any other discovery; a mismatch only affects the current
+    run, since the next one finds the confirmed state in the mapping.
+    """
+    resolved = await resolve_unmapped_pincodes(
+        inferred, pincode_index, record=record, db=db
+    )
+    mismatched = {
+        pincode: (alias, resolved[pincode])
+        for pincode, alias in inferred.items()
+        if resolved.get(pincode) and resolved[pincode] != alias
+    }
+    if mismatched:
+        logger.warning(
+            f"Prefix inference was wrong for {len(mismatched)} pincodes "
+            f"(inferred, actual): {mismatched}"
+        )
+    return resolved
+
+
+async def check_products_for_users(db):
+    logger.info("Starting product check for all users")
+    confirm_task = None
+    try:
+        await db.cleanup_state_history()
+        await session_cache.load(db)
+        await product_response_cache.load(db)
+        await last_notified_buffer.load(db)
+        telegram_scheduler.attach(db)
+        message_render_cache.clear()
+        # Log user statistics
+        user_stats = await db.get_user_statistics()
+        if user_stats:
+            preference_stats = {
+                "until_stop": 0,
+                "once_and_stop": 0,
+                "once_per_restock": 0,
+            }
+            preference_stats.update(user_stats["preferences"])
+            logger.info(f"User Statistics:")
+            logger.info(f"Total Users: {user_stats['total']}")
+            logger.info(f"Active Users: {user_stats['active']}")
+            logger.info(f"Configured Users: {user_stats['configured']}")
+            logger.info(f"Notification Preferences: {preference_stats}")
+        state_groups = {}
+        unmapped_users = []
+        unresolved = {}  # pincode -> users waiting for it to be mapped
+        inferred = {}  # pincode -> alias guessed from its postal prefix
+        # Pincodes that recently had no substore or kept failing to resolve
+        negative_pincodes = await db.get_negative_pincodes()
+        skipped_pincodes = set()
+        pincode_index = get_pincode_index() if USE_SUBSTORE_CACHE else PincodeIndex([])
+        # Only active users with a pincode and products, streamed and projected
+        async for user in db.iter_checker_users():
+            if not isinstance(user, dict):
+                logger.error(f"Invalid user data type: {type(user)}")
+                continue
+            pincode = user.get("pincode")
+            if not pincode:
+                logger.warning(f"User {user.get('chat_id')} has no pincode")
+                continue
+            pincode = str(pincode).strip()
+            state_alias = pincode_index.state_for(pincode)
+            if not state_alias and FALLBACK_TO_PINCODE_CACHE:
+                state_alias = pincode_cache.get(pincode)
+            if not state_alias and pincode in negative_pincodes:
+                skipped_pincodes.add(pincode)
+                unmapped_users.append(user)
+                continue
+            if not state_alias and PINCODE_PREFIX_INFERENCE:
+                # Checked under the guessed state now; the background lookup
+                # records the real one, so later runs need no lookup at all
+                state_alias = pincode_index.infer_state(pincode)
+                if state_alias:
+                    inferred[pincode] = state_alias
+            if not state_alias:
+                # Resolved together after the scan, once per distinct pincode
+                unresolved.setdefault(pincode, []).append(user)
+                continue
+            state_groups.setdefault(state_alias, []).append(user)
+
+        if skipped_pincodes:
+            logger.info(
+                f"Skipping {len(skipped_pincodes)} pincodes in the negative cache"
+            )
+        if unresolved:
+            resolved = await resolve_unmapped_pincodes(
+                unresolved, pincode_index, record=USE_SUBSTORE_CACHE, db=db
+            )
+            for pincode, users in unresolved.items():
+                state_alias = resolved.get(pincode)
+                if state_alias:
+                    state_groups.setdefault(state_alias, []).extend(users)
+                else:
+                    unmapped_users.extend(users)
+        if unmapped_users:
+            logger.warning(
+                f"Skipping {len(unmapped_users)} users whose pincode could not be mapped"
+            )
+        if inferred:
+            logger.info(
+                f"Inferred the state of {len(inferred)} pincodes from their prefix, "
+                "confirming in the background"
+            )
+            confirm_task = create_task_catching(
+                confirm_inferred_pincodes(
+                    inferred, pincode_index, record=USE_SUBSTORE_CACHE, db=db
                 )
-                # Find the user object for this chat_id
-                user = next(
-                    (
-                        u
-                        for users in state_groups.values()
-                        for u in users
-                        if str(u.get("chat_id")) == str(chat_id)
-                    ),
-                    None,
+            )
+
+        if not state_groups:
+            logger.warning("No active users to check")
+            return
+        # Kept apart from the user dicts so the masks are never persisted
+        product_masks = build_product_masks(
+            user for users in state_groups.values() for user in users
+        )
+        states_to_check = list(state_groups.keys())
+        logger.info(f"Checking {len(states_to_check)} states")
+
+        app = Application.builder().token(TELEGRAM_BOT_TOKEN).build()
+        await app.initialize()
+        try:
+            substore_ids = pincode_index.substore_ids()
+            if NOTIFICATION_OUTBOX_ENABLED:
+                await run_outbox_notifications(
+                    app,
+                    db,
+                    state_groups,
+                    states_to_check,
+                    substore_ids,
+                    product_masks,
                 )
-                # Create and add the task with name for better tracking
-                task = asyncio.create_task(
-                    locked_send(
-                        chat_id,
-                        user,
-                        products_to_check,
-                        notify_products,
-                        products_notified,
-                    ),
-                    name=f"notify_{chat_id}",
+            elif NOTIFICATION_PIPELINE_ENABLED:
+                await run_notification_pipeline(
+                    app,
+                    db,
+                    state_groups,
+                    states_to_check,
+                    substore_ids,
+                    product_masks,
                 )
-                notification_tasks.append(task)
-
-            # Wait for all notification tasks to complete and handle any errors
-            if notification_tasks:
-                logger.info(
-                    f"Waiting for {len(notification_tasks)} notification tasks to complete..."
+            else:
+                await run_gathered_notifications(
+                    app,
+                    db,
+                    state_groups,
+                    states_to_check,
+                    substore_ids,
+                    product_masks,
                 )
-                try:
-                    results = await asyncio.gather(
-                        *notification_tasks, return_exceptions=True
-                    )
-                    success_count = 0
-                    permanent_error_count = 0
-                    temp_error_count = 0
-
-                    for i, result in enumerate(results):
-                        task_name = notification_tasks[i].get_name()
-                        if isinstance(result, Exception):
-                            logger.error(
-                                f"Notification task {task_name} failed with error: {str(result)}"
-                            )
-                            temp_error_count += 1
-                        elif result is True:
-                            success_count += 1
-                        elif result is None:
-                            permanent_error_count += 1
-                        else:
-                            temp_error_count += 1
 
-                    logger.info(
-                        f"Completed notifications: {success_count} successful, "
-                        f"{permanent_error_count} permanent failures, "
-                        f"{temp_error_count} temporary failures out of {len(notification_tasks)} total"
-                    )
-                except Exception as e:
-                    logger.error(f"Error while gathering notification tasks: {str(e)}")
-            else:
-                logger.info("No notifications to send")
-            logger.info("All notification tasks completed")
+            await last_notified_buffer.flush()
 
             for state_alias, users in state_groups.items():
                 for user in users:
@@ -773,10 +1320,7 @@ async def check_products_for_users(db):
                         continue
                     chat_id = user.get("chat_id")
                     products_to_check = user.get("products", [])
-                    check_all_products = (
-                        len(products_to_check) == 1
-                        and products_to_check[0].strip().lower() == "any"
-                    )
+                    check_all_products = is_any_subscription(products_to_check)
                     if user.get("notification_preference") == "once_and_stop":
                         last_notified = user.get("last_notified", {})
                         if check_all_products:
@@ -788,10 +1332,13 @@ async def check_products_for_users(db):
                                     "active", True
                                 ):  # Only send message if user is still active
                                     user["active"] = False
-                                    await db.update_user(chat_id, user)
-                                    await app.bot.send_message(
-                                        chat_id=chat_id,
-                                        text="Notifications stopped after first available product notification. Use /start to reactivate and get notifications for more products.",
+                                    await db.update_user_partial(
+                                        chat_id, ["active"], False
+                                    )
+                                    await telegram_scheduler.send_message(
+                                        app.bot,
+                                        chat_id,
+                                        "Notifications stopped after first available product notification. Use /start to reactivate and get notifications for more products.",
                                         parse_mode="Markdown",
                                     )
                         else:
@@ -803,10 +1350,13 @@ async def check_products_for_users(db):
                                 "active", True
                             ):  # Only send message if user is still active
                                 user["active"] = False
-                                await db.update_user(chat_id, user)
-                                await app.bot.send_message(
-                                    chat_id=chat_id,
-                                    text="Notified for all tracked products. Notifications stopped. Use /start to reactivate.",
+                                await db.update_user_partial(
+                                    chat_id, ["active"], False
+                                )
+                                await telegram_scheduler.send_message(
+                                    app.bot,
+                                    chat_id,
+                                    "Notified for all tracked products. Notifications stopped. Use /start to reactivate.",
                                     parse_mode="Markdown",
                                 )
 
@@ -814,6 +1364,20 @@ async def check_products_for_users(db):
             await app.shutdown()
             logger.info("Telegram application shutdown completed")
     finally:
+        log_rate_limiter_stats()
+        telegram_scheduler.log_stats()
+        message_render_cache.log_stats()
+        if confirm_task is not None:
+            try:
+                await confirm_task
+            except Exception as e:
+                logger.error(f"Confirming inferred pincodes failed: {e}")
+        if discovery_journal.pending:
+            await discovery_journal.compact(get_pincode_index())
+        await last_notified_buffer.close()
+        await session_cache.close()
+        product_response_cache.close()
+        await close_http_client()
         await db.close()
         logger.info("Database connection closed")
     logger.info("Product check completed")
@@ -0,0 +1,82 @@
+import asyncio
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucketRateLimiter:
+    """Async token bucket with burst capacity and wait-time statistics.
+
+    Tokens refill continuously at `rate_per_sec` up to `burst`. A caller that
+    finds a token available takes it without suspending. Otherwise it reserves
+    the next token (the balance goes negative) and sleeps until that token
+    has accrued, so waiters are served in arrival order without a lock.
+    """
+
+    def __init__(self, rate_per_sec, burst=1, name="default"):
+        self.name = name
+        self.rate = float(rate_per_sec)
+        self.capacity = max(1, int(burst))
+        self._tokens = float(self.capacity)
+        self._updated = time.monotonic()
+        self._acquired = 0
+        self._waited = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def set_rate(self, rate_per_sec):
+        """Change the refill rate, keeping tokens accrued at the old rate."""
+        self._refill()
+        self.rate = float(rate_per_sec)
+
+    def try_acquire(self):
+        """Take a token if one is available right now."""
+        self._refill()
+        if self._tokens >= 1:
+            self._tokens -= 1
+            self._acquired += 1
+            return True
+        return False
+
+    async def wait(self):
+        self._refill()
+        self._tokens -= 1
+        self._acquired += 1
+        if self._tokens >= 0:
+            return
+        wait_time = -self._tokens / self.rate
+        self._waited += 1
+        self._total_wait += wait_time
+        self._max_wait = max(self._max_wait, wait_time)
+        logger.debug(
+            f"[RATE LIMIT] {self.name}: waiting {wait_time:.2f}s for a token"
+        )
+        try:
+            await asyncio.sleep(wait_time)
+        except asyncio.CancelledError:
+            # Give the reserved token back so later waiters are not delayed
+            self._tokens += 1
+            self._acquired -= 1
+            raise
+
+    def stats(self):
+        return {
+            "name": self.name,
+            "rate": self.rate,
+            "burst": self.capacity,
+            "acquired": self._acquired,
+            "waited": self._waited,
+            "total_wait": round(self._total_wait, 3),
+            "max_wait": round(self._max_wait, 3),
+            "avg_wait": round(self._total_wait / self._waited, 3)
+            if self._waited
+            else 0.0,
+        }
@@ -0,0 +1,76 @@
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+class ResponseCache:
+    """Validator/body cache for conditional product API requests.
+
+    Entries are keyed by (substore_id, cache_key), where cache_key is the
+    product alias or the batch query page, and persisted through the
+    Database so the ETag/Last-Modified validators survive across runs.
+    When the server answers 304 the cached body is served and the aliases it
+    covers are remembered as unchanged for the current fetch of that
+    substore, so the checker can skip writing their state again.
+    """
+
+    def __init__(self):
+        self._db = None
+        self._entries = {}  # (substore_id, cache_key) -> entry dict
+        self._unchanged = {}  # substore_id -> set of aliases served from a 304
+
+    async def load(self, db):
+        """Attach the database and load persisted validators from it."""
+        self._db = db
+        self._entries = await db.get_product_response_cache()
+        logger.info(f"[RESPONSE CACHE] Loaded {len(self._entries)} cached responses")
+
+    def begin(self, substore_id):
+        """Start a new fetch for a substore, forgetting previous 304s."""
+        self._unchanged[substore_id] = set()
+
+    def conditional_headers(self, substore_id, cache_key):
+        entry = self._entries.get((substore_id, cache_key))
+        headers = {}
+        if entry:
+            if entry.get("etag"):
+                headers["if-none-match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["if-modified-since"] = entry["last_modified"]
+        return headers
+
+    def get_body(self, substore_id, cache_key):
+        entry = self._entries.get((substore_id, cache_key))
+        return entry["body"] if entry else None
+
+    def mark_unchanged(self, substore_id, aliases):
+        self._unchanged.setdefault(substore_id, set()).update(aliases)
+
+    def unchanged_aliases(self, substore_id):
+        return self._unchanged.get(substore_id, set())
+
+    async def store(self, substore_id, cache_key, headers, body):
+        """Remember a 200 response if the server sent any validators."""
+        etag = headers.get("ETag")
+        last_modified = headers.get("Last-Modified")
+        if not etag and not last_modified:
+            return
+        entry = {
+            "etag": etag,
+            "last_modified": last_modified,
+            "body": body,
+            "updated_at": datetime.now(),
+        }
+        self._entries[(substore_id, cache_key)] = entry
+        if self._db is not None:
+            await self._db.save_product_response(
+                substore_id, cache_key, etag, last_modified, body, entry["updated_at"]
+            )
+
+    def close(self):
+        self._db = None
+        self._unchanged.clear()
+
+
+product_response_cache = ResponseCache()
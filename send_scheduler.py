@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import time
+from datetime import timedelta
+
+from telegram.error import (
+    BadRequest,
+    ChatMigrated,
+    Forbidden,
+    NetworkError,
+    RetryAfter,
+    TelegramError,
+)
+
+from config import (
+    TELEGRAM_GLOBAL_BURST,
+    TELEGRAM_GLOBAL_RATE,
+    TELEGRAM_MAX_RETRY_AFTER_WAIT,
+    TELEGRAM_PER_CHAT_INTERVAL,
+    TELEGRAM_SEND_RETRIES,
+    TELEGRAM_SEND_TIMEOUT,
+)
+from rate_limiter import TokenBucketRateLimiter
+
+logger = logging.getLogger(__name__)
+
+# Outcomes of TelegramSendScheduler.send_message
+SENT = "sent"
+BLOCKED = "blocked"  # Forbidden: the user blocked the bot or left the chat
+REJECTED = "rejected"  # BadRequest: retrying cannot succeed
+FAILED = "failed"  # Temporary errors that outlasted the retries
+
+
+class TelegramSendScheduler:
+    """Paces bot messages under Telegram's global and per-chat limits.
+
+    Every send takes a token from a global bucket refilled at `global_rate`
+    messages per second and waits until `per_chat_interval` has passed since
+    the previous message to the same chat. A RetryAfter from Telegram pauses
+    all sends for the requested time before the message is retried, until
+    the message has waited max_retry_after_wait seconds in total. Errors
+    are classified by exception type: Forbidden and BadRequest are final,
+    network errors and timeouts are retried with backoff. A ChatMigrated
+    redirects the message to the new supergroup chat, whose id is stored
+    for the user when a database is attached.
+    """
+
+    def __init__(
+        self,
+        global_rate=TELEGRAM_GLOBAL_RATE,
+        global_burst=TELEGRAM_GLOBAL_BURST,
+        per_chat_interval=TELEGRAM_PER_CHAT_INTERVAL,
+        max_retries=TELEGRAM_SEND_RETRIES,
+        send_timeout=TELEGRAM_SEND_TIMEOUT,
+        max_retry_after_wait=TELEGRAM_MAX_RETRY_AFTER_WAIT,
+    ):
+        self.global_limiter = TokenBucketRateLimiter(
+            global_rate, burst=global_burst, name="telegram"
+        )
+        self.per_chat_interval = per_chat_interval
+        self.max_retries = max_retries
+        self.send_timeout = send_timeout
+        self.max_retry_after_wait = max_retry_after_wait
+        self._chat_next_send = {}  # chat_id -> monotonic time of next allowed send
+        self._paused_until = 0.0
+        self._counts = {SENT: 0, BLOCKED: 0, REJECTED: 0, FAILED: 0}
+        self._retry_after_count = 0
+        self._db = None
+
+    def attach(self, db):
+        """Use db to move users whose chat migrated to a supergroup."""
+        self._db = db
+
+    async def _wait_for_chat(self, chat_id):
+        now = time.monotonic()
+        next_send = max(now, self._chat_next_send.get(chat_id, now))
+        # Reserve the slot before sleeping so concurrent sends queue behind it
+        self._chat_next_send[chat_id] = next_send + self.per_chat_interval
+        if next_send > now:
+            await asyncio.sleep(next_send - now)
+        if len(self._chat_next_send) > 10000:
+            self._chat_next_send = {
+                cid: t for cid, t in self._chat_next_send.items() if t > now
+            }
+
+    async def _wait_for_pause(self):
+        while True:
+            remaining = self._paused_until - time.monotonic()
+            if remaining <= 0:
+                return
+            await asyncio.sleep(remaining)
+
+    def _pause(self, retry_after):
+        """Pause all sends for retry_after and return it in seconds."""
+        if isinstance(retry_after, timedelta):
+            retry_after = retry_after.total_seconds()
+        retry_after = float(retry_after)
+        self._retry_after_count += 1
+        self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+        logger.warning(f"[TELEGRAM] Flood control, pausing sends for {retry_after}s")
+        return retry_after
+
+    def _finish(self, outcome):
+        self._counts[outcome] += 1
+        return outcome
+
+    async def send_message(self, bot, chat_id, text, max_retries=None, **kwargs):
+        """Send a message, returning SENT, BLOCKED, REJECTED or FAILED."""
+        max_retries = max_retries or self.max_retries
+        await self._wait_for_chat(chat_id)
+        attempt = 0
+        retry_after_waited = 0.0
+        migrated = False
+        while True:
+            await self._wait_for_pause()
+            await self.global_limiter.wait()
+            if self._paused_until > time.monotonic():
+                # Flood control started while this send waited for a token
+                continue
+            try:
+                async with asyncio.timeout(self.send_timeout):
+                    await bot.send_message(chat_id=chat_id, text=text, **kwargs)
+                return self._finish(SENT)
+            except RetryAfter as e:
+                # Flood control is bot-wide; the wait does not use up a retry
+                retry_after_waited += self._pause(e.retry_after)
+                if retry_after_waited > self.max_retry_after_wait:
+                    logger.error(
+                        f"Giving up on chat {chat_id} after {retry_after_waited:.0f}s "
+                        "of flood control waits"
+                    )
+                    return self._finish(FAILED)
+                continue
+            except Forbidden as e:
+                logger.error(f"Chat {chat_id} blocked the bot: {e}")
+                return self._finish(BLOCKED)
+            except ChatMigrated as e:
+                if migrated:
+                    logger.error(f"Chat {chat_id} migrated again: {e}")
+                    return self._finish(REJECTED)
+                migrated = True
+                logger.warning(
+                    f"Chat {chat_id} migrated to {e.new_chat_id}, resending there"
+                )
+                if self._db is not None:
+                    await self._db.migrate_chat_id(chat_id, e.new_chat_id)
+                chat_id = e.new_chat_id
+                await self._wait_for_chat(chat_id)
+                continue
+            except BadRequest as e:
+                logger.error(f"Telegram rejected message to chat {chat_id}: {e}")
+                return self._finish(REJECTED)
+            except (TimeoutError, NetworkError, TelegramError) as e:
+                attempt += 1
+                if attempt >= max_retries:
+                    logger.error(
+                        f"Giving up on chat {chat_id} after {attempt} attempts: {e!r}"
+                    )
+                    return self._finish(FAILED)
+                delay = 2 ** (attempt - 1)
+                logger.warning(
+                    f"Send to chat {chat_id} failed ({e!r}), retry {attempt + 1}/{max_retries} in {delay}s"
+                )
+                await asyncio.sleep(delay)
+
+    def stats(self):
+        return {
+            **self._counts,
+            "retry_after": self._retry_after_count,
+            "limiter": self.global_limiter.stats(),
+        }
+
+    def log_stats(self):
+        logger.info(f"[TELEGRAM] Send stats: {self.stats()}")
+
+
+telegram_scheduler = TelegramSendScheduler()
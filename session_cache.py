@@ -0,0 +1,145 @@
+import asyncio
+import logging
+from datetime import datetime, timedelta
+from api_client import bootstrap_session
+from cache import substore_pincode_map
+from config import COOKIE_REFRESH_INTERVAL, SESSION_REFRESH_MARGIN
+
+logger = logging.getLogger(__name__)
+
+
+class SessionCache:
+    """Cache of bootstrapped API sessions keyed by substore_id.
+
+    Entries hold the tid, cookies and substore returned by bootstrap_session
+    and are persisted through the Database so they survive across runs.
+    An entry is served until COOKIE_REFRESH_INTERVAL seconds after it was
+    created; within SESSION_REFRESH_MARGIN of expiry it is still served
+    but a background refresh is started.
+    """
+
+    def __init__(self, ttl=COOKIE_REFRESH_INTERVAL, refresh_margin=SESSION_REFRESH_MARGIN):
+        self.ttl = timedelta(seconds=ttl)
+        self.refresh_margin = timedelta(seconds=refresh_margin)
+        self._db = None
+        self._entries = {}  # substore_id -> session entry dict
+        self._refresh_tasks = {}  # substore_id -> asyncio.Task
+
+    async def load(self, db):
+        """Attach the database and load persisted sessions from it."""
+        self._db = db
+        self._entries = await db.get_api_sessions()
+        for substore_id, entry in self._entries.items():
+            substore_pincode_map.setdefault(entry["pincode"], substore_id)
+        logger.info(f"[SESSION CACHE] Loaded {len(self._entries)} persisted sessions")
+
+    def _age(self, entry):
+        return datetime.now() - entry["created_at"]
+
+    async def get_session(self, pincode, substore_id=None):
+        """Return (tid, substore, substore_id, cookies) for a pincode.
+
+        substore_id is an optional hint, e.g. from the substore mapping; when
+        it is missing the pincode -> substore_id map is consulted.
+        """
+        substore_id = substore_id or substore_pincode_map.get(str(pincode))
+        entry = self._entries.get(substore_id) if substore_id else None
+        if entry:
+            age = self._age(entry)
+            if age < self.ttl:
+                if age >= self.ttl - self.refresh_margin:
+                    self._schedule_refresh(pincode, substore_id)
+                logger.info(
+                    f"[SESSION CACHE] Hit for substore {substore_id} (age {age.total_seconds():.0f}s)"
+                )
+                return (
+                    entry["tid"],
+                    entry["substore"],
+                    entry["substore_id"],
+                    entry["cookies"],
+                )
+            logger.info(f"[SESSION CACHE] Expired session for substore {substore_id}")
+        return await self.refresh(pincode)
+
+    async def refresh(self, pincode):
+        """Bootstrap a new session for a pincode and store it."""
+        tid, substore, substore_id, cookies = await bootstrap_session(pincode)
+        entry = {
+            "substore_id": substore_id,
+            "pincode": str(pincode),
+            "tid": tid,
+            "substore": substore,
+            "cookies": cookies,
+            "created_at": datetime.now(),
+        }
+        self._entries[substore_id] = entry
+        substore_pincode_map[str(pincode)] = substore_id
+        if self._db is not None:
+            await self._db.save_api_session(
+                substore_id, pincode, tid, substore, cookies, entry["created_at"]
+            )
+        return tid, substore, substore_id, cookies
+
+    async def refresh_after_unauthorized(self, pincode, substore_id, stale_tid):
+        """Single-flight refresh for a session the server rejected with 401.
+
+        The first caller for a substore starts the refresh; concurrent callers
+        await the same task. A caller whose stale tid has already been
+        replaced gets the current session without another bootstrap.
+        """
+        entry = self._entries.get(substore_id)
+        if entry and entry["tid"] != stale_tid:
+            logger.info(
+                f"[SESSION CACHE] Session for substore {substore_id} already refreshed"
+            )
+            return (
+                entry["tid"],
+                entry["substore"],
+                entry["substore_id"],
+                entry["cookies"],
+            )
+        task = self._refresh_tasks.get(substore_id)
+        if task is None or task.done():
+            logger.info(
+                f"[SESSION CACHE] Refreshing rejected session for substore {substore_id}"
+            )
+            task = self._start_refresh(pincode, substore_id)
+        return await asyncio.shield(task)
+
+    def _start_refresh(self, pincode, substore_id):
+        task = asyncio.create_task(
+            self.refresh(pincode), name=f"session_refresh_{substore_id}"
+        )
+        task.add_done_callback(
+            lambda t, substore_id=substore_id: self._log_refresh_failure(
+                t, substore_id
+            )
+        )
+        self._refresh_tasks[substore_id] = task
+        return task
+
+    def _log_refresh_failure(self, task, substore_id):
+        if not task.cancelled() and task.exception():
+            logger.warning(
+                f"[SESSION CACHE] Refresh failed for substore {substore_id}: {task.exception()}"
+            )
+
+    def _schedule_refresh(self, pincode, substore_id):
+        task = self._refresh_tasks.get(substore_id)
+        if task and not task.done():
+            return
+        logger.info(
+            f"[SESSION CACHE] Session for substore {substore_id} is close to expiry, refreshing in background"
+        )
+        self._start_refresh(pincode, substore_id)
+
+    async def close(self):
+        """Wait for background refreshes so their results are persisted."""
+        pending = [t for t in self._refresh_tasks.values() if not t.done()]
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+        self._refresh_tasks.clear()
+        self._db = None
+
+
+session_cache = SessionCache()
@@ -1,44 +1,368 @@
-import importlib
+import asyncio
+import hashlib
+import importlib.util
 import json
-from config import SUBSTORE_LIST_FILE
+import os
+import time
+from types import MappingProxyType
+from config import (
+    SUBSTORE_JOURNAL_COMPACT_SIZE,
+    SUBSTORE_JOURNAL_FILE,
+    SUBSTORE_LIST_FILE,
+    SUBSTORE_MAPPING_FILE,
+)
 import logging
 
 logger = logging.getLogger(__name__)
 
+SUBSTORE_MAPPING_VERSION = 1
+# PIN code prefixes that identify a postal circle / region
+PINCODE_PREFIX_LENGTHS = (2, 3)
 
-def load_substore_mapping():
+
+class SubstoreMappingError(ValueError):
+    """The substore mapping file is unreadable, outdated or corrupt."""
+
+
+def _normalize_substore(sub):
+    # Handle _id: deduplicate whether list or comma-string
+    if isinstance(sub.get("_id"), list):
+        unique_ids = list(dict.fromkeys(sub["_id"]))
+    elif isinstance(sub.get("_id"), str) and "," in sub["_id"]:
+        unique_ids = list(
+            dict.fromkeys(id_.strip() for id_ in sub["_id"].split(",") if id_.strip())
+        )
+    else:
+        unique_ids = [sub["_id"]] if sub.get("_id") else []
+
+    if len(unique_ids) > 1:
+        logger.warning(
+            f"Multiple unique _ids for alias {sub.get('alias')}: {unique_ids}. Using first."
+        )
+
+    # Ensure pincodes is a sorted, deduplicated list of strings
+    pincodes = sub.get("pincodes", [])
+    if isinstance(pincodes, str):
+        pincodes = pincodes.split(",")
+    pincodes = sorted({str(p).strip() for p in pincodes if str(p).strip()})
+
+    return {
+        "alias": sub["alias"],
+        "_id": unique_ids[0] if unique_ids else "",
+        "name": sub.get("name") or sub["alias"].title(),
+        "pincodes": pincodes,
+    }
+
+
+def _checksum(substores):
+    payload = json.dumps(
+        substores, separators=(",", ":"), sort_keys=True, ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _read_mapping_file(path=SUBSTORE_MAPPING_FILE):
+    with open(path, encoding="utf-8") as f:
+        data = json.load(f)
+    if data.get("version") != SUBSTORE_MAPPING_VERSION:
+        raise SubstoreMappingError(
+            f"{path} has version {data.get('version')}, "
+            f"expected {SUBSTORE_MAPPING_VERSION}"
+        )
+    substores = data.get("substores")
+    if not isinstance(substores, list) or data.get("checksum") != _checksum(substores):
+        raise SubstoreMappingError(f"{path} failed its checksum")
+    return substores
+
+
+def _load_legacy_substore_list():
+    """Exec the old substore_list.py module and normalize its entries."""
     spec = importlib.util.spec_from_file_location("substore_list", SUBSTORE_LIST_FILE)
     substore_list = importlib.util.module_from_spec(spec)
     spec.loader.exec_module(substore_list)
+    return [_normalize_substore(sub) for sub in substore_list.substore_info]
 
-    for sub in substore_list.substore_info:
-        # Handle _id: deduplicate whether list or comma-string
-        if isinstance(sub["_id"], list):
-            unique_ids = list(set(sub["_id"]))
-        elif isinstance(sub["_id"], str) and "," in sub["_id"]:
-            unique_ids = list(
-                set(id_.strip() for id_ in sub["_id"].split(",") if id_.strip())
-            )
-        else:
-            unique_ids = [sub["_id"]] if sub.get("_id") else []
 
-        if len(unique_ids) > 1:
-            logger.warning(
-                f"Multiple unique _ids for alias {sub.get('alias')}: {unique_ids}. Using first."
-            )
-        sub["_id"] = unique_ids[0] if unique_ids else ""
+def load_substore_mapping():
+    """Load the substore mapping from the compact data file.
 
-        # Ensure pincodes is list and deduplicated
-        pincodes = sub.get("pincodes", [])
-        if isinstance(pincodes, str):
-            pincodes = [p.strip() for p in pincodes.split(",") if p.strip()]
-        sub["pincodes"] = list(set(pincodes))  # Dedup
+    The file is normalized when written, so it is only parsed and checked
+    against its checksum here. If it is missing, the legacy substore_list.py
+    is converted once and saved in the new format. If it is invalid, it is
+    moved aside for recovery and the legacy data is used without saving it;
+    the discovery journal is replayed on top as usual.
+    """
+    missing = False
+    try:
+        return _read_mapping_file()
+    except FileNotFoundError:
+        missing = True
+        logger.info(
+            f"{SUBSTORE_MAPPING_FILE} not found, converting {SUBSTORE_LIST_FILE}"
+        )
+    except ValueError as e:
+        corrupt_file = f"{SUBSTORE_MAPPING_FILE}.corrupt-{int(time.time())}"
+        logger.error(
+            f"Could not load {SUBSTORE_MAPPING_FILE}: {e}. Moving it to "
+            f"{corrupt_file}; pincodes compacted into it are missing until it "
+            "is recovered"
+        )
+        try:
+            os.replace(SUBSTORE_MAPPING_FILE, corrupt_file)
+        except OSError as move_error:
+            logger.error(f"Could not move {SUBSTORE_MAPPING_FILE}: {move_error}")
+    except OSError as e:
+        logger.error(f"Could not load {SUBSTORE_MAPPING_FILE}: {e}")
 
-    return substore_list.substore_info
+    if not os.path.exists(SUBSTORE_LIST_FILE):
+        logger.error("No substore mapping available, starting with an empty one")
+        return []
+    substores = _load_legacy_substore_list()
+    if missing:
+        save_substore_mapping(substores)
+    return substores
 
 
 def save_substore_mapping(substore_info):
-    with open(SUBSTORE_LIST_FILE, "w", encoding="utf-8") as f:
-        f.write(
-            "substore_info = " + json.dumps(substore_info, indent=4, ensure_ascii=False)
+    """Normalize and atomically write the mapping to the data file."""
+    substores = [_normalize_substore(sub) for sub in substore_info]
+    data = {
+        "version": SUBSTORE_MAPPING_VERSION,
+        "checksum": _checksum(substores),
+        "substores": substores,
+    }
+    tmp_file = f"{SUBSTORE_MAPPING_FILE}.tmp"
+    with open(tmp_file, "w", encoding="utf-8") as f:
+        json.dump(data, f, separators=(",", ":"), ensure_ascii=False)
+        # The data must be on disk before the rename makes it the mapping
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, SUBSTORE_MAPPING_FILE)
+
+
+class PincodeIndex:
+    """Pincode -> substore lookup built once from the substore mapping.
+
+    The pincodes loaded from the mapping are held in a read-only dict, so
+    lookups are O(1) instead of a scan over every substore's pincode list.
+    Pincodes discovered later are added incrementally with add(), which
+    records them in a separate dict and in their substore entry.
+
+    The leading digits of a PIN code identify its postal circle, so the
+    states seen under each 2- and 3-digit prefix are also kept. infer_state()
+    uses them to guess the state of an unknown pincode when its prefix
+    belongs to a single state.
+    """
+
+    def __init__(self, substore_info):
+        self._substores = {}  # alias -> substore entry
+        by_pincode = {}
+        for sub in substore_info:
+            entry = dict(sub, pincodes=[str(p) for p in sub.get("pincodes", [])])
+            self._substores.setdefault(entry["alias"], entry)
+            for pincode in entry["pincodes"]:
+                by_pincode.setdefault(pincode, entry["alias"])
+        self._by_pincode = MappingProxyType(by_pincode)
+        self._discovered = {}  # pincode -> alias, added after load
+        self._prefixes = {}  # 2/3-digit prefix -> set of aliases
+        for pincode, alias in by_pincode.items():
+            self._add_prefixes(pincode, alias)
+
+    def __len__(self):
+        return len(self._by_pincode) + len(self._discovered)
+
+    def state_for(self, pincode):
+        """Return the substore alias serving pincode, or None."""
+        pincode = str(pincode).strip()
+        return self._discovered.get(pincode) or self._by_pincode.get(pincode)
+
+    def _add_prefixes(self, pincode, alias):
+        for length in PINCODE_PREFIX_LENGTHS:
+            if len(pincode) > length:
+                self._prefixes.setdefault(pincode[:length], set()).add(alias)
+
+    def infer_state(self, pincode):
+        """Guess the alias for an unknown pincode from its postal prefix.
+
+        Tries the longest known prefix; returns None when it is shared by
+        several states or no pincode with that prefix is known.
+        """
+        pincode = str(pincode).strip()
+        for length in sorted(PINCODE_PREFIX_LENGTHS, reverse=True):
+            aliases = self._prefixes.get(pincode[:length])
+            if aliases:
+                return next(iter(aliases)) if len(aliases) == 1 else None
+        return None
+
+    def substore(self, alias):
+        return self._substores.get(alias)
+
+    def state_name_for(self, pincode):
+        """Return the display name of the state serving pincode, or None."""
+        sub = self._substores.get(self.state_for(pincode))
+        return sub["name"] if sub else None
+
+    def substore_ids(self):
+        return {alias: sub.get("_id") for alias, sub in self._substores.items()}
+
+    def add(self, pincode, alias, substore_id="", name=None):
+        """Record a discovered pincode. Returns True if the mapping changed."""
+        pincode = str(pincode).strip()
+        changed = False
+        sub = self._substores.get(alias)
+        if sub is None:
+            sub = {
+                "alias": alias,
+                "_id": substore_id,
+                "name": name or alias.title(),
+                "pincodes": [],
+            }
+            self._substores[alias] = sub
+            changed = True
+            logger.info(
+                f"Created new substore entry for {alias} with pincode {pincode}"
+            )
+        elif not sub.get("_id") and substore_id:
+            sub["_id"] = substore_id
+            changed = True
+            logger.info(f"Updated empty _id for substore {alias} to {substore_id}")
+        previous = self.state_for(pincode)
+        if previous != alias:
+            if previous is not None:
+                # Remapped: drop it from the old substore's pincode list
+                old_pincodes = self._substores[previous]["pincodes"]
+                if pincode in old_pincodes:
+                    old_pincodes.remove(pincode)
+                logger.info(f"Moved pincode {pincode} from {previous} to {alias}")
+            self._discovered[pincode] = alias
+            sub["pincodes"].append(pincode)
+            self._add_prefixes(pincode, alias)
+            changed = True
+            logger.info(f"Added pincode {pincode} to substore {alias}")
+        return changed
+
+    def to_substore_info(self):
+        """Return the mapping as a substore_info list for saving."""
+        return list(self._substores.values())
+
+
+class DiscoveryJournal:
+    """Append-only log of pincodes discovered since the last compaction.
+
+    Each discovery is appended as one JSON line and fsynced in a worker
+    thread, so recording it costs O(1) I/O off the event loop instead of
+    rewriting the whole mapping. Appends and compactions are serialized by
+    a lock. The journal is
+    replayed over the mapping when the pincode index is built and compacted
+    into the mapping file (an atomic replace) once it holds compact_size
+    entries or at the end of a run. A torn trailing line left by a crash is
+    skipped on replay, and replaying entries already compacted is a no-op.
+    """
+
+    def __init__(
+        self, path=SUBSTORE_JOURNAL_FILE, compact_size=SUBSTORE_JOURNAL_COMPACT_SIZE
+    ):
+        self.path = path
+        self.compact_size = compact_size
+        self.pending = 0  # entries in the journal file
+        self._torn_tail = False  # last line was cut short by a crash
+        self._lock = asyncio.Lock()
+
+    def replay(self, index):
+        """Apply journaled discoveries to index."""
+        self.pending = 0
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return
+        except OSError as e:
+            logger.error(f"Could not read {self.path}: {e}")
+            return
+        self._torn_tail = bool(lines) and not lines[-1].endswith("\n")
+        for line_no, line in enumerate(lines, 1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+                index.add(
+                    entry["pincode"],
+                    entry["alias"],
+                    entry.get("_id", ""),
+                    entry.get("name"),
+                )
+            except (ValueError, KeyError, TypeError) as e:
+                logger.warning(f"Skipping bad line {line_no} in {self.path}: {e}")
+                continue
+            self.pending += 1
+        if self.pending:
+            logger.info(f"Replayed {self.pending} discovered pincodes from {self.path}")
+
+    def _append(self, line):
+        with open(self.path, "a", encoding="utf-8") as f:
+            if self._torn_tail:
+                # Keep a crash's partial line from swallowing this entry
+                f.write("\n")
+                self._torn_tail = False
+            f.write(line + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    async def record(self, index, pincode, alias, substore_id="", name=None):
+        """Append a discovery and compact the journal when it is full."""
+        line = json.dumps(
+            {"pincode": str(pincode), "alias": alias, "_id": substore_id, "name": name},
+            ensure_ascii=False,
         )
+        async with self._lock:
+            try:
+                await asyncio.to_thread(self._append, line)
+            except OSError as e:
+                logger.error(f"Could not journal pincode {pincode}: {e}")
+                return
+            self.pending += 1
+            if self.pending >= self.compact_size:
+                await self._compact(index)
+
+    async def compact(self, index):
+        """Write index to the mapping file and start an empty journal."""
+        async with self._lock:
+            await self._compact(index)
+
+    def _write_compacted(self, substores):
+        save_substore_mapping(substores)
+        # Safe to lose the journal now; a crash before this replays no-ops
+        os.remove(self.path)
+
+    async def _compact(self, index):
+        if not self.pending:
+            return
+        # Snapshot on the loop so discoveries made meanwhile cannot race it
+        substores = [
+            dict(sub, pincodes=list(sub["pincodes"]))
+            for sub in index.to_substore_info()
+        ]
+        try:
+            await asyncio.to_thread(self._write_compacted, substores)
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.error(f"Could not compact {self.path}: {e}")
+            return
+        logger.info(f"Compacted {self.pending} discovered pincodes into the mapping")
+        self.pending = 0
+
+
+discovery_journal = DiscoveryJournal()
+
+_pincode_index = None
+
+
+def get_pincode_index():
+    """Return the shared PincodeIndex, building it on first use."""
+    global _pincode_index
+    if _pincode_index is None:
+        _pincode_index = PincodeIndex(load_substore_mapping())
+        discovery_journal.replay(_pincode_index)
+        logger.info(f"Built pincode index with {len(_pincode_index)} pincodes")
+    return _pincode_index